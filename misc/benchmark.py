@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+#
+# benchmark.py -- benchmark harness for alirelval
+#
+# Sets up a throwaway environment: synthetic package listings served by a
+# local HTTP stub, a database seeded with many validations and fake unpack,
+# validation and status commands with a configurable latency. Then times the
+# CLI operations end to end and some internal hot functions, and prints the
+# results as JSON, so that they can be compared between versions.
+#
+# Usage: misc/benchmark.py [--listing-lines N] [--validations N] [--running N]
+#          [--latency SECONDS] [--repeat N] [--output FILE] [--keep]
+#
+
+import sys, os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import subprocess
+from getopt import gnu_getopt, GetoptError
+import SimpleHTTPServer, BaseHTTPServer
+
+pylib = os.path.dirname( os.path.abspath(__file__) ) + '/../pylib'
+alirelval_bin = os.path.dirname( os.path.abspath(__file__) ) + '/../bin/alirelval'
+sys.path.insert(0, pylib)
+
+import alirelval
+from alirelval.alipack import AliPack
+from alirelval.valstatus import ValStatus
+from alirelval.enum import Enum
+
+archs = [ 'x86_64-2.6-gnu-4.1.2', 'x86_64-2.6-gnu-4.7.2', 'x86_64-2.6-gnu-4.8.4', 'i686-2.6-gnu-4.1.2' ]
+deps = 'VO_ALICE@ROOT::v5-34-08,VO_ALICE@GEANT3::v1-15a'
+
+
+def get_listing_line(i):
+  arch = archs[i % len(archs)]
+  version = 'v5-%02d-Rev-%d' % (i // 1000 % 100, i)
+  return 'aliroot-%s-Linux-%s.tar.gz AliRoot %s Linux-%s VO_ALICE@AliRoot::%s %s\n' % \
+    (version, arch, version, arch.split('-', 1)[0], version, deps)
+
+
+def write_listings(wwwdir, lines):
+  os.makedirs(wwwdir+'/tarballs')
+  with open(wwwdir+'/tarballs/Packages', 'w') as f:
+    for i in xrange(lines):
+      f.write( get_listing_line(i) )
+  with open(wwwdir+'/tarballs/Packages-Validation', 'w') as f:
+    for i in xrange( min(lines, 1000) ):
+      f.write( get_listing_line(i) )
+
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+def start_http_stub(wwwdir):
+  '''Serves wwwdir on a random local port from a background thread. Returns
+     the base URL.
+  '''
+  os.chdir(wwwdir)
+  httpd = BaseHTTPServer.HTTPServer( ('127.0.0.1', 0), QuietHandler )
+  t = threading.Thread(target=httpd.serve_forever)
+  t.daemon = True
+  t.start()
+  return 'http://127.0.0.1:%d/tarballs' % httpd.server_address[1]
+
+
+def write_stub_commands(bindir, latency):
+  '''Fake commands sleeping for the given latency. The status command always
+     answers RUNNING, so that the database does not change between runs.
+  '''
+  os.makedirs(bindir)
+  cmds = {
+    'unpack.sh': 'sleep %s\nmkdir -p "$1"\n',
+    'relval.sh': 'sleep %s\n',
+    'status.sh': 'sleep %s\nexit 100\n'
+  }
+  for name, body in cmds.items():
+    with open('%s/%s' % (bindir, name), 'w') as f:
+      f.write( '#!/bin/sh\n' + body % latency )
+    os.chmod('%s/%s' % (bindir, name), 0755)
+
+
+def write_config(workdir, baseurl):
+  confdir = workdir + '/home/.alirelval'
+  os.makedirs(confdir)
+  with open(confdir+'/alirelval.conf', 'w') as f:
+    f.write('''[alirelval]
+packbaseurl = %(baseurl)s
+unpackdir = %(w)s/export/$ARCH/$VERSION
+modulefile = %(w)s/modules/$ARCH/$VERSION
+unpackcmd = %(w)s/bin/unpack.sh $DESTDIR
+relvalcmd = %(w)s/bin/relval.sh
+statuscmd = %(w)s/bin/status.sh
+maxrunning = 0
+prefetch = 0
+prefetchminfree = 0
+
+[mail]
+host = 127.0.0.1
+port = 1
+''' % { 'w': workdir, 'baseurl': baseurl })
+  return confdir + '/status.sqlite'
+
+
+def seed_db(dbpath, baseurl, nval, nrunning):
+  '''Creates the database and fills it with nval validations of distinct
+     packages, the last nrunning of which are running, the others done.
+  '''
+  valstatus = ValStatus(dbpath=dbpath, baseurl=baseurl)
+  del valstatus
+  db = sqlite3.connect(dbpath)
+  packs = []
+  for i in xrange( min(nval, 100000) ):
+    a = get_listing_line(i).split()
+    arch = archs[i % len(archs)]
+    packs.append( (a[0], 'AliRoot', 'VO_ALICE', a[2], 'Linux', arch, deps) )
+  db.executemany('INSERT INTO package(tarball,software,org,version,platform,arch,deps) VALUES(?,?,?,?,?,?,?)', packs)
+  # timestamps are in microseconds
+  start = int( (time.time() - nval*60) * 1000000 )
+  def vals():
+    for i in xrange(nval):
+      inserted = start + i*60000000
+      if i >= nval-nrunning:
+        yield (inserted, inserted+10000000, None, ValStatus.status.RUNNING, i % len(packs) + 1)
+      else:
+        yield (inserted, inserted+10000000, inserted+3600000000, ValStatus.status.DONE_OK, i % len(packs) + 1)
+  db.executemany('INSERT INTO validation(inserted,started,ended,status,package_id) VALUES(?,?,?,?,?)', vals())
+  db.commit()
+  db.close()
+
+
+def time_runs(func, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    func()
+    times.append( time.time()-start )
+  times.sort()
+  return {
+    'runs': repeat,
+    'min': times[0],
+    'median': times[len(times)//2],
+    'max': times[-1]
+  }
+
+
+def run_cli(workdir, args):
+  env = os.environ.copy()
+  env['HOME'] = workdir + '/home'
+  with open(os.devnull, 'w') as devnull:
+    rc = subprocess.call([ sys.executable, alirelval_bin ] + args, stdout=devnull, stderr=devnull, env=env)
+  if rc != 0:
+    sys.stderr.write('warning: "%s" exited with %d\n' % (' '.join(args), rc))
+
+
+def main(argv):
+  params = {
+    'listing_lines': 10000,
+    'validations': 100000,
+    'running': 20,
+    'latency': 0.05,
+    'repeat': 5
+  }
+  output = None
+  keep = False
+  try:
+    opts, args = gnu_getopt(argv, '', [ 'listing-lines=', 'validations=', 'running=', 'latency=', 'repeat=', 'output=',
+      'keep' ])
+    for o, a in opts:
+      if o == '--latency':
+        params['latency'] = float(a)
+      elif o == '--output':
+        output = a
+      elif o == '--keep':
+        keep = True
+      else:
+        params[ o[2:].replace('-', '_') ] = int(a)
+  except (GetoptError, ValueError) as e:
+    sys.stderr.write('error parsing options: %s\n' % e)
+    return 1
+
+  workdir = tempfile.mkdtemp(prefix='alirelval-bench-')
+  try:
+    sys.stderr.write('setting up benchmark environment in %s\n' % workdir)
+    write_listings(workdir+'/www', params['listing_lines'])
+    baseurl = start_http_stub(workdir+'/www')
+    write_stub_commands(workdir+'/bin', params['latency'])
+    dbpath = write_config(workdir, baseurl)
+    seed_db(dbpath, baseurl, params['validations'], params['running'])
+    results = {
+      'version': alirelval.__version__,
+      'timestamp': time.time(),
+      'params': params,
+      'cli': {},
+      'functions': {}
+    }
+    repeat = params['repeat']
+
+    # end to end timings of the CLI operations, in a fresh process each
+    cli = [
+      ('version', [ 'version' ]),
+      ('help', [ 'help' ]),
+      ('list-limit-100', [ 'list', '--limit=100' ]),
+      ('list-jsonl', [ 'list', '--format=jsonl' ]),
+      ('list-queued', [ 'list-queued-validations' ]),
+      ('list-pub-packages-jsonl', [ 'list-pub-packages', '--format=jsonl', '--refresh' ]),
+      ('list-pub-packages-cached', [ 'list-pub-packages', '--format=jsonl' ]),
+      ('sync-packages', [ 'sync-packages', '--refresh' ]),
+      ('queue-validation-dryrun', [ 'queue-validation', '--dry-run', '--tarball', get_listing_line(1).split()[0] ]),
+      ('run-queued-noop', [ 'run-queued' ]),
+      ('update-dryrun', [ 'update', '--dry-run' ])
+    ]
+    for name, args in cli:
+      sys.stderr.write('timing CLI operation: %s\n' % name)
+      results['cli'][name] = time_runs(lambda: run_cli(workdir, args), repeat)
+
+    # internal hot functions
+    lines = [ get_listing_line(i) for i in xrange(params['listing_lines']) ]
+    def parse_listing():
+      for l in lines:
+        AliPack(rawstring=l, baseurl=baseurl)
+    sys.stderr.write('timing function: AliPack._from_str\n')
+    results['functions']['AliPack._from_str'] = time_runs(parse_listing, repeat)
+    results['functions']['AliPack._from_str']['items'] = len(lines)
+
+    valstatus = ValStatus(dbpath=dbpath, baseurl=baseurl)
+    sys.stderr.write('timing function: ValStatus.get_validations\n')
+    results['functions']['ValStatus.get_validations'] = time_runs(valstatus.get_validations, repeat)
+    results['functions']['ValStatus.get_validations']['items'] = params['validations']
+
+    statusmap = Enum({ 'RUNNING': 100, 'NOT_RUNNING': 101, 'DONE_OK': 102, 'DONE_FAIL': 103 })
+    def refresh():
+      alirelval.refresh_validations(valstatus, statuscmd=workdir+'/bin/status.sh', statusmap=statusmap,
+        resultsurl='http://localhost/$SESSIONTAG', dryrun=True, workers=4)
+    sys.stderr.write('timing function: refresh_validations\n')
+    results['functions']['refresh_validations'] = time_runs(refresh, repeat)
+    results['functions']['refresh_validations']['items'] = params['running']
+
+  finally:
+    os.chdir('/')
+    if keep:
+      sys.stderr.write('keeping benchmark environment in %s\n' % workdir)
+    else:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  out = json.dumps(results, indent=2, sort_keys=True)
+  if output is not None:
+    with open(output, 'w') as f:
+      f.write(out + '\n')
+  else:
+    print out
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit( main(sys.argv[1:]) )
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+#
+# test-mirrors.py -- tests of the package mirror pool
+#
+# Starts throwaway HTTP/1.1 mirrors on random local ports, each behaving in a
+# different way (healthy, failing, missing all files, closing its keep-alive
+# connections while idle), and checks how a MirrorPool fails over between
+# them, which status it returns, how it reuses and replaces connections and
+# how it backs off failing mirrors.
+#
+# Usage: misc/test-mirrors.py [-v]
+#
+
+import sys, os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+import threading
+import BaseHTTPServer, SocketServer
+
+pylib = os.path.dirname( os.path.abspath(__file__) ) + '/../pylib'
+sys.path.insert(0, pylib)
+
+from alirelval.mirrors import MirrorPool, urlopen
+
+files = {
+  '/tarballs/Packages': ''.join([ 'line %d\n' % i for i in range(10000) ]) + 'last line',
+  '/tarballs/big.tar.gz': 'x' * 1048576
+}
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+
+  def do_GET(self):
+    self.server.requests += 1
+    behavior = self.server.behavior
+    if behavior == 'fail':
+      self.reply(503, 'unavailable\n')
+    elif behavior == 'missing' or self.path not in files:
+      self.reply(404, 'not found\n')
+    else:
+      self.reply(200, files[self.path])
+    if behavior == 'stale':
+      # keep-alive was not refused: the client finds out at its next request
+      self.close_connection = 1
+
+  def reply(self, code, body):
+    self.send_response(code)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self, behavior):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MirrorHandler)
+    self.behavior = behavior
+    self.connections = 0
+    self.requests = 0
+    t = threading.Thread(target=self.serve_forever)
+    t.daemon = True
+    t.start()
+
+  def get_url(self):
+    return 'http://127.0.0.1:%d/tarballs' % self.server_address[1]
+
+
+def read(resp):
+  try:
+    return resp.read()
+  finally:
+    resp.close()
+
+
+class MirrorPoolTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.servers = dict( (b, MirrorServer(b)) for b in [ 'ok', 'fail', 'missing', 'stale' ] )
+
+  @classmethod
+  def tearDownClass(cls):
+    for s in cls.servers.values():
+      s.shutdown()
+      s.server_close()
+
+  def setUp(self):
+    for s in self.servers.values():
+      s.connections = 0
+      s.requests = 0
+    self.workdir = tempfile.mkdtemp(prefix='alirelval-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def get_pool(self, behaviors, statefile=None):
+    pool = MirrorPool([ self.servers[b].get_url() for b in behaviors ], timeout=5, statefile=statefile)
+    self.addCleanup(pool.close)
+    return pool
+
+  def get_url(self, behavior, path='/Packages'):
+    return self.servers[behavior].get_url() + path
+
+  def test_failover(self):
+    pool = self.get_pool([ 'fail', 'ok' ])
+    resp = pool.urlopen(self.get_url('fail'))
+    self.assertEqual(resp.getcode(), 200, 'no failover to the healthy mirror')
+    self.assertEqual(read(resp), files['/tarballs/Packages'])
+    mirrors = pool.get_mirrors()
+    self.assertEqual(mirrors[0][0], self.servers['ok'].get_url(), 'healthy mirror not ranked first')
+    self.assertEqual(mirrors[1][1]['failures'], 1, 'failure of the failing mirror not counted')
+    self.assertTrue(mirrors[1][1]['down_until'] > time.time(), 'failing mirror not avoided')
+    requests = self.servers['fail'].requests
+    self.assertEqual(read(pool.urlopen(self.get_url('fail'))), files['/tarballs/Packages'])
+    self.assertEqual(self.servers['fail'].requests, requests, 'failing mirror tried before its backoff expired')
+
+  def test_statefile(self):
+    statefile = self.workdir + '/mirrors.json'
+    read( self.get_pool([ 'fail', 'ok' ], statefile).urlopen(self.get_url('fail')) )
+    requests = self.servers['fail'].requests
+    # a new pool knows from the state file that the first mirror is down
+    pool = self.get_pool([ 'fail', 'ok' ], statefile)
+    self.assertEqual(pool.get_mirrors()[0][0], self.servers['ok'].get_url(), 'mirror state not loaded')
+    self.assertNotEqual(pool.get_mirrors()[0][1]['latency'], None, 'mirror latency not saved')
+    self.assertEqual(read(pool.urlopen(self.get_url('fail'))), files['/tarballs/Packages'])
+    self.assertEqual(self.servers['fail'].requests, requests, 'mirror down in the state file tried first')
+
+  def test_not_found(self):
+    pool = self.get_pool([ 'fail', 'missing' ])
+    resp = pool.urlopen(self.get_url('fail'))
+    self.assertEqual(resp.getcode(), 404, 'server error returned instead of a 404')
+    read(resp)
+    # the failing mirror is now down: once a 404 is seen, it is not tried
+    requests = self.servers['fail'].requests
+    resp = pool.urlopen(self.get_url('fail'))
+    self.assertEqual(resp.getcode(), 404, 'wrong status when a mirror is down')
+    read(resp)
+    self.assertEqual(self.servers['fail'].requests, requests, 'mirror being avoided tried after a 404')
+    # a file missing on the preferred mirror is fetched from another one
+    resp = self.get_pool([ 'missing', 'ok' ]).urlopen(self.get_url('missing'))
+    self.assertEqual(resp.getcode(), 200, 'file missing on the first mirror not fetched from the second one')
+    read(resp)
+
+  def test_keepalive(self):
+    pool = self.get_pool([ 'ok' ])
+    for i in range(3):
+      self.assertEqual(read(pool.urlopen(self.get_url('ok'))), files['/tarballs/Packages'])
+    self.assertEqual(self.servers['ok'].connections, 1, 'connection not reused')
+    # error pages are short: they are drained and the connection is kept too
+    resp = pool.urlopen(self.get_url('ok', '/nonexistent'))
+    self.assertEqual(resp.getcode(), 404, 'missing file not reported')
+    resp.close()
+    read(pool.urlopen(self.get_url('ok')))
+    self.assertEqual(self.servers['ok'].connections, 1, 'connection not reused after a 404')
+
+  def test_stale_connection(self):
+    pool = self.get_pool([ 'stale' ])
+    for i in range(3):
+      self.assertEqual(read(pool.urlopen(self.get_url('stale'))), files['/tarballs/Packages'],
+        'wrong content after the server closed the pooled connection')
+    self.assertEqual(self.servers['stale'].connections, 3, 'stale connections not replaced')
+    self.assertEqual(pool.get_mirrors()[0][1]['failures'], 0, 'stale connection counted as a mirror failure')
+
+  def test_backoff(self):
+    pool = self.get_pool([ 'fail', 'ok' ])
+    base = self.servers['fail'].get_url()
+    for expected in [ 10, 20, 40, 80, 160, 320, 600, 600 ]:
+      pool._failed(base, 'test')
+      delay = pool.get_mirrors()[-1][1]['down_until'] - time.time()
+      self.assertTrue(expected-1 < delay <= expected, 'backoff of %d s instead of %d s' % (delay, expected))
+    pool._succeeded(base, 0.1)
+    st = dict(pool.get_mirrors())[base]
+    self.assertEqual((st['failures'], st['down_until']), (0, 0), 'success does not reset the backoff')
+
+  def test_all_down(self):
+    pool = self.get_pool([ 'fail' ])
+    resp = pool.urlopen(self.get_url('fail'))
+    self.assertEqual(resp.getcode(), 503, 'server error of the only mirror not returned')
+    resp.close()
+    # mirrors being avoided are still tried as a last resort
+    requests = self.servers['fail'].requests
+    pool.urlopen(self.get_url('fail')).close()
+    self.assertEqual(self.servers['fail'].requests, requests+1, 'last resort mirror not tried')
+    pool = MirrorPool([ 'http://127.0.0.1:1/tarballs' ], timeout=5)
+    self.assertRaises(IOError, pool.urlopen, 'http://127.0.0.1:1/tarballs/Packages')
+
+  def test_lines_and_throughput(self):
+    pool = self.get_pool([ 'ok' ])
+    resp = urlopen(self.get_url('ok'), mirrors=pool)
+    lines = list(resp)
+    resp.close()
+    self.assertEqual(len(lines), 10001, 'lines not split correctly')
+    self.assertEqual(''.join(lines), files['/tarballs/Packages'])
+    self.assertEqual(pool.get_mirrors()[0][1]['throughput'], None, 'throughput measured on a small transfer')
+    read(pool.urlopen(self.get_url('ok', '/big.tar.gz'), { 'Range': 'bytes=0-' }))
+    self.assertTrue(pool.get_mirrors()[0][1]['throughput'] > 0, 'throughput not measured')
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+#
+# test-outbox.py -- tests of the notification email outbox
+#
+# Starts a throwaway SMTP server on a random local port, which keeps the mails
+# it receives and rejects those whose subject contains "reject". Then queues
+# mails in the outbox of a temporary database and checks how flush_outbox()
+# and the flush-mail operation send them, coalesce them into a digest and
+# retry them with a backoff after failures.
+#
+# Usage: misc/test-outbox.py [-v]
+#
+
+import sys, os
+import time
+import email
+import smtpd
+import shutil
+import asyncore
+import logging
+import tempfile
+import unittest
+import threading
+import subprocess
+
+pylib = os.path.dirname( os.path.abspath(__file__) ) + '/../pylib'
+alirelval_bin = os.path.dirname( os.path.abspath(__file__) ) + '/../bin/alirelval'
+sys.path.insert(0, pylib)
+
+import alirelval
+from alirelval.valstatus import ValStatus
+
+baseurl = 'http://127.0.0.1:1/tarballs'
+
+
+class SinkServer(smtpd.SMTPServer):
+
+  def __init__(self):
+    smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+    self.port = self.socket.getsockname()[1]
+    self.received = []
+
+  def process_message(self, peer, mailfrom, rcpttos, data):
+    msg = email.message_from_string(data)
+    if 'reject' in msg['Subject']:
+      return '550 rejected for testing'
+    self.received.append( (rcpttos, msg) )
+
+
+class OutboxTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.sink = SinkServer()
+    t = threading.Thread(target=asyncore.loop, kwargs={ 'timeout': 0.1 })
+    t.daemon = True
+    t.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.sink.close()
+
+  def setUp(self):
+    del self.sink.received[:]
+    self.workdir = tempfile.mkdtemp(prefix='alirelval-test-')
+    self.valstatus = ValStatus(dbpath=self.workdir+'/status.sqlite', baseurl=baseurl)
+
+  def tearDown(self):
+    self.valstatus.close()
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def get_mail_config(self, **kw):
+    mail = {
+      'host': '127.0.0.1',
+      'port': self.sink.port,
+      'from': 'alirelval@localhost',
+      'to': 'one@localhost,two@localhost',
+      'timeout': 5,
+      'maxattempts': 3,
+      'retrydelay': 60,
+      'digest': False
+    }
+    mail.update(kw)
+    return mail
+
+  def queue_mails(self, subjects):
+    self.valstatus.add_mails([ (s, 'Body of %s.' % s) for s in subjects ])
+
+  def get_received_subjects(self):
+    return [ m['Subject'] for r, m in self.sink.received ]
+
+  def make_due(self):
+    self.valstatus._db.execute('UPDATE outbox SET next_attempt=0')
+    self.valstatus._db.commit()
+
+  def test_send(self):
+    self.queue_mails([ 'first', 'second', 'third' ])
+    self.assertEqual(self.valstatus.get_outbox_counts(3)['queued'], 3, 'mails not queued')
+    self.assertTrue(alirelval.flush_outbox(self.valstatus, self.get_mail_config()), 'flush failed')
+    self.assertEqual(self.get_received_subjects(), [ 'first', 'second', 'third' ], 'mails not sent in order')
+    self.assertEqual(self.sink.received[0][0], [ 'one@localhost', 'two@localhost' ], 'wrong recipients')
+    self.assertEqual(self.sink.received[0][1].get_payload(), 'Body of first.', 'wrong body')
+    self.assertEqual(self.valstatus.get_outbox_counts(3)['sent'], 3, 'mails not marked as sent')
+    del self.sink.received[:]
+    self.assertTrue(alirelval.flush_outbox(self.valstatus, self.get_mail_config()), 'empty flush failed')
+    self.assertEqual(self.sink.received, [], 'mails sent twice')
+
+  def test_digest(self):
+    self.queue_mails([ 'first', 'second', 'third' ])
+    self.assertTrue(alirelval.flush_outbox(self.valstatus, self.get_mail_config(digest=True)), 'flush failed')
+    self.assertEqual(self.get_received_subjects(), [ '[AliRelVal] 3 notifications' ], 'mails not coalesced')
+    body = self.sink.received[0][1].get_payload()
+    self.assertTrue(body.index('=== first ===') < body.index('=== second ===') < body.index('=== third ==='),
+      'digest does not contain the mails in order')
+    self.assertTrue('Body of second.' in body, 'digest does not contain the bodies')
+    self.assertEqual(self.valstatus.get_outbox_counts(3)['sent'], 3, 'coalesced mails not marked as sent')
+    # a single mail is not wrapped in a digest
+    del self.sink.received[:]
+    self.queue_mails([ 'alone' ])
+    alirelval.flush_outbox(self.valstatus, self.get_mail_config(digest=True))
+    self.assertEqual(self.get_received_subjects(), [ 'alone' ], 'single mail sent as a digest')
+
+  def test_rejected(self):
+    self.queue_mails([ 'first', 'reject me', 'third' ])
+    self.assertFalse(alirelval.flush_outbox(self.valstatus, self.get_mail_config()), 'rejection not reported')
+    self.assertEqual(self.get_received_subjects(), [ 'first', 'third' ], 'mails following a rejected one not sent')
+    counts = self.valstatus.get_outbox_counts(3)
+    self.assertEqual((counts['sent'], counts['retrying']), (2, 1), 'wrong outbox counts: %s' % counts)
+
+  def test_backoff(self):
+    self.queue_mails([ 'first', 'second' ])
+    # nothing listens on port 1
+    mail = self.get_mail_config(port=1, retrydelay=60)
+    for attempt, delay in [ (1, 60), (2, 120) ]:
+      start = time.time()
+      self.assertFalse(alirelval.flush_outbox(self.valstatus, mail), 'connection error not reported')
+      self.assertEqual(self.valstatus.get_pending_mails(3), [], 'failed mails retried before their backoff expired')
+      for r in self.valstatus._db.execute('SELECT attempts, next_attempt, last_error FROM outbox').fetchall():
+        self.assertEqual(r['attempts'], attempt, 'failed attempt not counted')
+        wait = r['next_attempt'] / 1000000. - start
+        self.assertTrue(delay-1 < wait <= delay+1, 'retry in %.1f s instead of %d s' % (wait, delay))
+        self.assertTrue(r['last_error'], 'error not recorded')
+      self.make_due()
+    # third and last attempt: the mails are given up
+    self.assertFalse(alirelval.flush_outbox(self.valstatus, mail), 'connection error not reported')
+    self.make_due()
+    self.assertEqual(self.valstatus.get_pending_mails(3), [], 'mails not given up after maxattempts failures')
+    self.assertEqual(self.valstatus.get_outbox_counts(3)['failed'], 2, 'given up mails not counted as failed')
+    # with a working server, mails still due are sent
+    self.valstatus._db.execute('UPDATE outbox SET attempts=1')
+    self.valstatus._db.commit()
+    self.assertTrue(alirelval.flush_outbox(self.valstatus, self.get_mail_config()), 'retry failed')
+    self.assertEqual(len(self.sink.received), 2, 'mails not sent at the retry')
+
+  def test_flush_mail(self):
+    home = self.workdir + '/home'
+    os.makedirs(home + '/.alirelval')
+    with open(home + '/.alirelval/alirelval.conf', 'w') as f:
+      f.write('[mail]\nhost = 127.0.0.1\nport = %d\ndigest = true\n' % self.sink.port)
+    valstatus = ValStatus(dbpath=home+'/.alirelval/status.sqlite', baseurl=baseurl)
+    self.addCleanup(valstatus.close)
+    valstatus.add_mails([ ('first', 'Body of first.'), ('second', 'Body of second.') ])
+    env = os.environ.copy()
+    env['HOME'] = home
+    def run(args):
+      with open(os.devnull, 'w') as devnull:
+        return subprocess.call([ sys.executable, alirelval_bin ] + args, stdout=devnull, stderr=devnull, env=env)
+    self.assertEqual(run([ 'flush-mail', '--dry-run' ]), 0, 'flush-mail --dry-run failed')
+    self.assertEqual(self.sink.received, [], 'mails sent in a dry run')
+    self.assertEqual(run([ 'flush-mail' ]), 0, 'flush-mail failed')
+    self.assertEqual(self.get_received_subjects(), [ '[AliRelVal] 2 notifications' ], 'no digest sent')
+    self.assertEqual(valstatus.get_outbox_counts(10)['sent'], 2, 'mails not marked as sent by flush-mail')
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.CRITICAL)
+  unittest.main()
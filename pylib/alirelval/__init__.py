@@ -6,43 +6,84 @@
 
 __version__ = '0.9.3'
 
-import sys, os, urllib
-from prettytable import PrettyTable
+import time
+_import_start = time.time()
+
+# only cheap modules here: the others (prettytable, urllib, smtplib,
+# subprocess, ConfigParser, sqlite3, calendar...) are imported by the
+# functions using them, so that operations not needing them start fast
+import sys, os
+import stat
+import errno
 from alipack import AliPack, AliPackError
 from valstatus import ValStatus
-import logging, logging.handlers
-import ConfigParser
+from locks import NamedLock
+import logging
 from getopt import gnu_getopt, GetoptError
-import sqlite3
 import string
-import subprocess
 import traceback
-import shutil
 from timestamp import TimeStamp
-import time
-from smtplib import SMTP
 from enum import Enum
 import bisect
+import signal
 
 
-def get_available_packages(baseurl, listpath='/Packages'):
+def open_listing(url, listcache=None, mirrors=None):
+  '''Returns the lines of the listing at url as an iterable, going through
+     the on-disk listing cache if provided (which has its own mirrors), or
+     else through the given mirrors. It must be closed after use. May throw
+     an IOError.
+  '''
+  if listcache is not None:
+    return listcache.iter_lines(url)
+  from mirrors import urlopen
+  resp = urlopen(url, mirrors=mirrors)
+  if resp.getcode() != 200:
+    resp.close()
+    raise IOError('code %d while reading %s' % (resp.getcode(), url))
+  return resp
+
+
+def iter_available_packages(baseurl, listpath='/Packages', listcache=None, tarballs=None, mirrors=None):
+  '''Generator yielding the available packages in AliEn one at a time, as they
+     are parsed off the listing at the given URL. If a collection of tarball
+     names is given, only lines referring to them are parsed and the generator
+     stops as soon as all of them have been found.
+  '''
+
+  log = get_logger()
+  log.debug('streaming list of available packages from %s%s' % (baseurl, listpath))
+  if tarballs is not None:
+    missing = set(tarballs)
+  resp = open_listing(baseurl+listpath, listcache=listcache, mirrors=mirrors) # IOError
+  try:
+    for l in resp:
+      if tarballs is not None:
+        head = l.split(None, 1)
+        if not head or head[0] not in missing:
+          continue
+      try:
+        packdef = AliPack(rawstring=l, baseurl=baseurl)
+      except AliPackError as e:
+        log.warning('quietly skipping unparsable package definition: %s' % e)
+        continue
+      yield packdef
+      if tarballs is not None:
+        missing.discard(packdef.tarball)
+        if not missing:
+          log.debug('all requested tarballs found: not reading the rest of the list')
+          break
+  finally:
+    resp.close()
+
+
+def get_available_packages(baseurl, listpath='/Packages', listcache=None):
   '''Returns a list of available packages in AliEn. The list is obtained from
-     the given URL.
+     the given URL, going through the on-disk listing cache if provided.
   '''
 
   log = get_logger()
-  log.debug('getting list of available packages from %s%s' % (baseurl, listpath))
-  packlist = []
-  resp = urllib.urlopen(baseurl+listpath)
-  if resp.getcode() != 200:
-    raise IOError('code %d while reading %s%s' % (resp.getcode(), baseurl, listpath))
-  for l in resp:
-    try:
-      packdef = AliPack(rawstring=l, baseurl=baseurl)
-      packlist.append(packdef)
-    except AliPackError as e:
-      log.warning('quietly skipping unparsable package definition: %s' % e)
-      pass
+  packlist = list( iter_available_packages(baseurl, listpath, listcache=listcache) )
   log.debug('created list of %d package(s)' % len(packlist))
   return packlist
 
@@ -72,7 +113,8 @@ def init_logger(log_directory=None, debug=False):
     if not os.path.isdir(log_directory):
       os.makedirs(log_directory, 0755)
 
-    log_file = logging.handlers.RotatingFileHandler(filename, mode='a', maxBytes=3000000, backupCount=100)
+    from logging.handlers import RotatingFileHandler
+    log_file = RotatingFileHandler(filename, mode='a', maxBytes=3000000, backupCount=100)
     log_file.setLevel(level)
     log_file.setFormatter( logging.Formatter(format, datefmt) )
     logging.getLogger('').addHandler(log_file)
@@ -83,6 +125,7 @@ def init_logger(log_directory=None, debug=False):
 
 
 def init_config(config_file):
+  import ConfigParser
   log = get_logger()
   parser = ConfigParser.SafeConfigParser()
   if os.path.isfile(config_file):
@@ -96,24 +139,62 @@ def init_config(config_file):
     'alirelval': {
       'logdir': ['path', '~/.alirelval/log'],
       'dbpath': ['path', '~/.alirelval/status.sqlite'],
-      'pidfile': ['path', '~/.alirelval/pid'],
+      'dbbusytimeout': ['int', 30],
+      'lockdir': ['path', '~/.alirelval/locks'],
+      'locktimeout': ['int', 10],
+      'listcachedir': ['path', '~/.alirelval/listcache'],
+      'listcachettl': ['int', 300],
       'packbaseurl': ['str', 'http://pcalienbuild4.cern.ch:8889/tarballs'],
+      'packmirrors': ['str', ''],
+      'mirrortimeout': ['int', 30],
+      'mirrorstate': ['path', '~/.alirelval/mirrors.json'],
       'resultsurl': ['str', 'http://localhost/$SESSIONTAG'],
-      'unpackdir': ['path', '/opt/alice/aliroot/export/arch/$ARCH/Packages/AliRoot/$VERSION'],
-      'modulefile': ['path', '/opt/alice/aliroot/export/arch/$ARCH/Modules/modulefiles/AliRoot/$VERSION'],
-      'unpackcmd': ['str', '/usr/bin/curl -L $URL | /usr/bin/tar --strip-components=1 -C $DESTDIR -xzvvf -'],
+      'unpackdir': ['path', '/opt/alice/aliroot/export/arch/$ARCH/Packages/$SOFTWARE/$VERSION'],
+      'modulefile': ['path', '/opt/alice/aliroot/export/arch/$ARCH/Modules/modulefiles/$SOFTWARE/$VERSION'],
+      'unpackcmd': ['str', ''],
+      'stagingdir': ['path', '~/.alirelval/staging'],
+      'prefetch': ['int', 2],
+      'prefetchworkers': ['int', 2],
+      'prefetchminfree': ['int', 10240],
+      'unpackquota': ['int', 0],
       'relvalcmd': ['str', '/bin/false'],
       'statuscmd': ['str', '/bin/false'],
+      'batchstatuscmd': ['str', ''],
+      'statusworkers': ['int', 4],
+      'statustimeout': ['int', 300],
+      'maxrunning': ['int', 1],
+      'archslots': ['str', ''],
+      'platformslots': ['str', ''],
       'statuscode_running': ['int', 100],
       'statuscode_notrunning': ['int', 101],
       'statuscode_doneok': ['int', 102],
-      'statuscode_donefail': ['int', 103]
+      'statuscode_donefail': ['int', 103],
+      'metricsfile': ['path', '~/.alirelval/metrics/alirelval.prom']
+    },
+    'daemon': {
+      'pidfile': ['path', '~/.alirelval/daemon.pid'],
+      'refreshinterval': ['int', 60],
+      'startinterval': ['int', 60],
+      'syncinterval': ['int', 600],
+      'gcinterval': ['int', 3600],
+      'mailinterval': ['int', 60],
+      'metricsinterval': ['int', 60],
+      'watchinterval': ['int', 0]
     },
     'mail': {
       'host': ['str', 'localhost'],
       'port': ['int', 25],
       'from': ['str', 'noreply@localhost'],
-      'to': ['str', 'noreply1@localhost,noreply2@localhost']
+      'to': ['str', 'noreply1@localhost,noreply2@localhost'],
+      'timeout': ['int', 30],
+      'maxattempts': ['int', 10],
+      'retrydelay': ['int', 60],
+      'digest': ['bool', False]
+    },
+    'watch': {
+      'software': ['str', ''],
+      'arch': ['str', ''],
+      'version': ['str', '']
     }
   }
 
@@ -152,25 +233,26 @@ def init_config(config_file):
   return config_vars
 
 
-def check_lock(pidfile):
+def acquire_locks(lockdir, locks, timeout=None):
+  '''Takes the given named locks, a list of (name, exclusive) tuples, in
+     order. Returns the list of held locks, or None if any of them could not
+     be taken within the timeout (in that case none is held).
+  '''
   log = get_logger()
-  attempts = 10
-  for i in range(1,attempts+1):
-    try:
-      with open(pidfile, 'r') as pf:
-        pid = int(pf.read())
-      log.debug('pidfile says: %d' % pid)
-      os.kill(pid, 0)
-      log.warning('attempt %d of %d: another instance with pid %d is running' % (i, attempts, pid))
-      time.sleep(1)
-    except (IOError, ValueError, OSError):
-      with open(pidfile, 'w') as pf:
-        pid = os.getpid()
-        pf.write( str(pid)+'\n' )
-      log.debug('writing current pid %d in pidfile %s' % (pid, pidfile))
-      return True
-  log.critical('timeout waiting other instance to finish: aborting')
-  return False
+  held = []
+  for name, exclusive in locks:
+    lock = NamedLock(lockdir=lockdir, name=name)
+    if not lock.acquire(exclusive=exclusive, timeout=timeout):
+      log.error('timeout waiting for lock %s held by another instance' % name)
+      release_locks(held)
+      return None
+    held.append(lock)
+  return held
+
+
+def release_locks(held):
+  for lock in reversed(held):
+    lock.release()
 
 
 def unhandled_exception(type, value, tb):
@@ -183,28 +265,129 @@ def unhandled_exception(type, value, tb):
         log.critical(l)
 
 
-def run_command(cmd, verbose=None, nonzero_raise=False):
+def get_session_argv(cmd):
+  '''Returns the argument list running the shell command cmd in a new session,
+     hence in its own process group, whose id is the pid of the process
+     started. Popen's preexec_fn is not used for that: in Python 2 it is not
+     safe in the presence of threads, and commands are run from worker
+     threads. util-linux's setsid is used if found, Python otherwise.
+  '''
+  for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+    setsid = os.path.join(d, 'setsid')
+    if d != '' and os.access(setsid, os.X_OK):
+      return [ setsid, '/bin/sh', '-c', cmd ]
+  return [ sys.executable, '-c',
+    'import os, sys; os.setsid(); os.execv("/bin/sh", [ "/bin/sh", "-c", sys.argv[1] ])', cmd ]
+
+
+def run_command(cmd, verbose=None, nonzero_raise=False, timeout=None):
   '''Runs a command. Returns the return code. Silences output according to the
      current debug level (can be overridden). Can raise exception if cmd
-     returns nonzero.
+     returns nonzero. If a timeout (in seconds) is given, the command runs in
+     its own process group, which is killed when the timeout expires: None is
+     returned in that case.
   '''
+  import subprocess
   log = get_logger()
   if verbose is None:
     verbose = log.getEffectiveLevel() <= logging.DEBUG  # note: logging.NOTSET == 0
+  if timeout is not None:
+    argv = get_session_argv(cmd)
+  else:
+    argv = [ '/bin/sh', '-c', cmd ]
   log.debug('executing command: %s' % cmd)
   if verbose:
-    sp = subprocess.Popen(cmd, shell=True)
+    sp = subprocess.Popen(argv)
   else:
     with open(os.devnull) as dev_null:
-     sp = subprocess.Popen(cmd, stderr=dev_null, stdout=dev_null, shell=True)
-  rc = sp.wait()
+     sp = subprocess.Popen(argv, stderr=dev_null, stdout=dev_null)
+  if timeout is None:
+    rc = sp.wait()
+  else:
+    deadline = time.time() + timeout
+    while True:
+      rc = sp.poll()
+      if rc is not None:
+        break
+      if time.time() > deadline:
+        log.warning('command "%s" timed out after %d s: killing its process group' % (cmd, timeout))
+        try:
+          os.killpg(sp.pid, signal.SIGKILL)
+        except OSError:
+          pass
+        sp.wait()
+        if nonzero_raise:
+          raise OSError('command "%s" timed out' % cmd)
+        return None
+      time.sleep(0.1)
   if rc != 0 and nonzero_raise:
     raise OSError('command "%s" had nonzero (%d) exit status' % (cmd, rc))
   else:
     return rc
 
 
+def run_command_output(cmd, input='', timeout=None):
+  '''Runs a command feeding the given input to its stdin. Returns a tuple with
+     the return code and the standard output. Standard error is silenced
+     according to the current debug level. If a timeout (in seconds) is given
+     and expires, the command's process group is killed and the return code
+     is None.
+  '''
+  import subprocess, threading
+  log = get_logger()
+  verbose = log.getEffectiveLevel() <= logging.DEBUG
+  log.debug('executing command: %s' % cmd)
+  with open(os.devnull, 'w') as dev_null:
+    if verbose:
+      stderr = None
+    else:
+      stderr = dev_null
+    sp = subprocess.Popen(get_session_argv(cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+      stderr=stderr)
+  timedout = []
+  def kill():
+    log.warning('command "%s" timed out after %d s: killing its process group' % (cmd, timeout))
+    timedout.append(True)
+    try:
+      os.killpg(sp.pid, signal.SIGKILL)
+    except OSError:
+      pass
+  if timeout is not None:
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+  try:
+    out = sp.communicate(input)[0]
+  finally:
+    if timeout is not None:
+      timer.cancel()
+  if timedout:
+    return (None, out)
+  return (sp.returncode, out)
+
+
+def run_commands(cmds, workers=1, timeout=None):
+  '''Runs the given commands through a pool of at most the given number of
+     workers. Returns a list of (return code, start TimeStamp, duration in
+     seconds) in the same order as cmds. The return code is None for
+     commands that timed out.
+  '''
+  if len(cmds) == 0:
+    return []
+  def run(cmd):
+    started = TimeStamp()
+    rc = run_command(cmd, timeout=timeout)
+    return (rc, started, started.get_elapsed_sec())
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool( max(1, min(workers, len(cmds))) )
+  try:
+    return pool.map(run, cmds)
+  finally:
+    pool.close()
+    pool.join()
+
+
 def show_help(actions):
+  from prettytable import PrettyTable
   tab = PrettyTable( [ 'Operation', 'Alternative names' ] )
   for k in tab.align.keys():
     tab.align[k] = 'l'
@@ -224,20 +407,28 @@ def show_version():
 
 
 what_pack = Enum([ 'CACHED', 'VALIDATION', 'PUBLISHED' ])
-def list_packages(baseurl, what, extended=False, valstatus=None):
+def list_packages(baseurl, what, extended=False, valstatus=None, listcache=None, format='table', mirrors=None):
   log = get_logger()
   if what == what_pack.CACHED:
-    packs = valstatus.get_packages()
+    packs = valstatus.iter_packages()
   elif what == what_pack.PUBLISHED:
-    packs = get_available_packages(baseurl) # IOError
+    packs = iter_available_packages(baseurl, '/Packages', listcache=listcache, mirrors=mirrors) # IOError
   elif what == what_pack.VALIDATION:
-    packs = get_available_packages(baseurl, '/Packages-Validation') # IOError
+    packs = iter_available_packages(baseurl, '/Packages-Validation', listcache=listcache, mirrors=mirrors) # IOError
   else:
     assert False, 'invalid parameter'
-  if extended:
+  if format != 'table':
+    from recordwriter import RecordWriter
+    out = RecordWriter(fmt=format, fields=[ 'tarball', 'package', 'software', 'version', 'org', 'platform', 'arch',
+      'deps', 'fetched', 'url' ])
+    for p in packs:
+      out.write([ p.tarball, p.get_package_name(), p.software, p.version, p.org, p.platform, p.arch,
+        p.deps, p.fetched, p.get_url() ])
+  elif extended:
     for p in packs:
       print p
   else:
+    from prettytable import PrettyTable
     tab = PrettyTable( [ 'Package', 'Platform', 'Arch', 'URL' ] )
     for k in tab.align.keys():
       tab.align[k] = 'l'
@@ -257,47 +448,276 @@ def list_packages(baseurl, what, extended=False, valstatus=None):
   return True
 
 
-def queue_validation(valstatus, baseurl, tarball, dryrun=False):
+def queue_validation(valstatus, baseurl, tarballs, dryrun=False, extended=False, listcache=None, format='table',
+  mirrors=None):
+  '''Queues a validation for each of the given tarballs (read from stdin, one
+     per line, if none is given). Tarballs unknown to the database are
+     resolved with a single pass on the remote listing, and all validations
+     are queued in a single transaction.
+  '''
   log = get_logger()
-  if tarball is None:
-    log.debug('tarball not provided, waiting on stdin (terminate with EOF)...')
-    inp = sys.stdin.read()
-    tarball = inp.strip()
-    log.debug('tarball to validate (from stdin): %s' % tarball)
+  if not tarballs:
+    log.debug('tarballs not provided, waiting on stdin, one per line (terminate with EOF)...')
+    tarballs = sys.stdin.read().split('\n')
+  uniq = []
+  for t in tarballs:
+    t = t.strip()
+    if t != '' and t not in uniq:
+      uniq.append(t)
+  tarballs = uniq
+  log.debug('tarballs to validate: %s' % ', '.join(tarballs))
+
+  # packages to validate (cache in sqlite)
+  packs = {}
+  for t in tarballs:
+    pack = valstatus.get_cached_pack_from_tarball(t)
+    if pack is not None:
+      packs[t] = pack
+  missing = [ t for t in tarballs if t not in packs ]
+  if missing:
+    log.debug('%d tarball(s) not in db: searching in the remote list' % len(missing))
+    found = list( iter_available_packages(baseurl, '/Packages-Validation', listcache=listcache, tarballs=missing,
+      mirrors=mirrors) )
+    if found:
+      valstatus.sync_packages(found)
+    for pack in found:
+      packs[pack.tarball] = pack
+
+  # queue validations
+  tovalidate = [ packs[t] for t in tarballs if t in packs ]
+  for package_id, name in valstatus.get_dependency_graph([ p.id for p in tovalidate ])[2]:
+    log.warning('dependency %s of package %d is unknown: sync packages to resolve it' % (name, package_id))
+  if dryrun:
+    log.info('DRY RUN: not queuing validations')
+    queued = [ None ] * len(tovalidate)
   else:
-    log.debug('tarball to validate: %s' % tarball)
-  # package to validate (cache in sqlite)
-  pack = valstatus.get_cached_pack_from_tarball(tarball)
-  if pack is None:
-    pack = valstatus.get_cached_pack_from_tarball(tarball, get_available_packages(baseurl, '/Packages-Validation'))
-  if pack is None:
-    log.error('package from tarball %s not found!' % tarball)
-    return False
+    queued = valstatus.add_validations(tovalidate)
+  result = dict( zip([ p.tarball for p in tovalidate ], queued) )
+
+  if format != 'table':
+    from recordwriter import RecordWriter
+    out = RecordWriter(fmt=format, fields=[ 'tarball', 'result' ])
   else:
-    print pack
-    # queue validation
-    if dryrun:
-      log.info('DRY RUN: not queuing validation of %s' % pack.tarball)
+    if extended:
+      for p in tovalidate:
+        print p
+    from prettytable import PrettyTable
+    out = PrettyTable( [ 'Tarball', 'Result' ] )
+    for k in out.align.keys():
+      out.align[k] = 'l'
+    out.padding_width = 1
+  ok = True
+  for t in tarballs:
+    if t not in result:
+      log.error('package from tarball %s not found!' % t)
+      res = 'not found'
+      ok = False
+    elif result[t] is None:
+      res = 'dry run'
+    elif result[t]:
+      log.info('queued validation of %s' % t)
+      res = 'queued'
     else:
-      if valstatus.add_validation(pack):
-        log.info('queued validation of %s' % pack.tarball)
+      log.warning('validation of %s already queued' % t)
+      res = 'already queued'
+    if format != 'table':
+      out.write([ t, res ])
+    else:
+      out.add_row([ t, res ])
+  if format == 'table':
+    print out
+  return ok
+
+
+def sync_packages(valstatus, baseurl, dryrun=False, listcache=None, mirrors=None):
+  '''Imports the full validation and published listings into the local
+     database, so that later lookups do not need to touch the network.
+  '''
+  log = get_logger()
+  packs = []
+  for listpath in [ '/Packages-Validation', '/Packages' ]:
+    packs.extend( iter_available_packages(baseurl, listpath, listcache=listcache, mirrors=mirrors) ) # IOError
+  added = valstatus.sync_packages(packs, dryrun=dryrun)
+  if dryrun:
+    log.info('DRY RUN: %d package(s) would have been added out of %d listed' % (added, len(packs)))
+  else:
+    log.info('synced %d package(s): %d new' % (len(packs), added))
+  return True
+
+
+def match_patterns(value, patterns):
+  '''Tells whether value matches any of the comma-separated shell-like
+     patterns. An empty list of patterns matches everything.
+  '''
+  import fnmatch
+  patterns = [ p.strip() for p in patterns.split(',') if p.strip() != '' ]
+  if not patterns:
+    return True
+  for p in patterns:
+    if fnmatch.fnmatchcase(value, p):
+      return True
+  return False
+
+
+def watch_packages(valstatus, baseurl, watch, dryrun=False, listcache=None, mirrors=None):
+  '''Queues a validation for each tarball which appeared in the validation
+     listing since the last time it was watched, provided that it matches the
+     software, arch and version patterns of the watch configuration. The
+     listing is diffed against the set of tarballs last seen: only new lines
+     are parsed. With the listing cache, an unchanged listing costs a single
+     conditional request and is not read at all. The first time, the listing
+     is only recorded and nothing is queued.
+  '''
+  log = get_logger()
+  url = baseurl + '/Packages-Validation'
+  lastdigest = valstatus.get_watch_digest(url)
+  if listcache is not None:
+    if listcache.get_digest(url) == lastdigest: # IOError
+      log.debug('listing %s unchanged since last seen' % url)
+      return True
+    resp = listcache.iter_lines(url, revalidate=False)
+  else:
+    resp = open_listing(url, mirrors=mirrors) # IOError
+
+  # digest of what is actually read, to compare with the cache next time
+  import hashlib
+  sha1 = hashlib.sha1()
+  seen = valstatus.get_watched_tarballs(url)
+  present = set()
+  newlines = []
+  try:
+    for l in resp:
+      sha1.update(l)
+      head = l.split(None, 1)
+      if not head:
+        continue
+      present.add(head[0])
+      if head[0] not in seen:
+        newlines.append(l)
+  finally:
+    resp.close()
+  digest = sha1.hexdigest()
+  if digest == lastdigest:
+    log.debug('listing %s unchanged since last seen' % url)
+    return True
+  added = present - seen
+  removed = seen - present
+  log.debug('listing %s changed: %d tarball(s) appeared, %d disappeared' % (url, len(added), len(removed)))
+
+  packs = []
+  if lastdigest is None:
+    log.info('watching %s for the first time: %d tarball(s) recorded, none queued' % (url, len(added)))
+  else:
+    for l in newlines:
+      try:
+        pack = AliPack(rawstring=l, baseurl=baseurl)
+      except AliPackError as e:
+        log.warning('quietly skipping unparsable package definition: %s' % e)
+        continue
+      if match_patterns(pack.software, watch['software']) and match_patterns(pack.arch, watch['arch']) and \
+         match_patterns(pack.version, watch['version']):
+        packs.append(pack)
       else:
-        log.warning('validation of %s already queued' % pack.tarball)
+        log.debug('new tarball %s does not match the watch patterns: ignoring it' % pack.tarball)
+
+  if dryrun:
+    for pack in packs:
+      log.info('DRY RUN: not queuing validation of new tarball %s' % pack.tarball)
     return True
+  if packs:
+    valstatus.sync_packages(packs)
+    for pack, queued in zip(packs, valstatus.add_validations(packs)):
+      if queued:
+        log.info('queued validation of new tarball %s' % pack.tarball)
+      else:
+        log.warning('validation of new tarball %s already queued' % pack.tarball)
+  valstatus.update_watch(url, digest, added, removed)
+  return True
+
+
+def parse_time(s):
+  '''Converts a UTC date in one of the TimeStamp.datefmt formats, or a raw
+     timestamp in seconds, to a timestamp in microseconds. Throws a
+     ValueError if it cannot.
+  '''
+  try:
+    return TimeStamp.from_seconds( float(s) ).get_timestamp_usec_utc()
+  except ValueError:
+    pass
+  import calendar
+  for fmt in [ TimeStamp.datefmt.NO_USEC, TimeStamp.datefmt.DATE_ONLY ]:
+    try:
+      return calendar.timegm( time.strptime(s, fmt) ) * 1000000
+    except ValueError:
+      pass
+  raise ValueError('invalid date: %s' % s)
+
+
+def format_page_cursor(v):
+  return '%d:%d' % (v.inserted.get_timestamp_usec_utc(), v.id)
+
+
+def parse_page_cursor(s):
+  '''Returns the (inserted, validation_id) tuple encoded in a page cursor as
+     printed by format_page_cursor(). Throws a ValueError if invalid.
+  '''
+  try:
+    inserted, valid = s.rsplit(':', 1)
+    return (int(inserted), int(valid))
+  except ValueError:
+    raise ValueError('invalid page cursor: %s' % s)
 
 
 what_val = Enum([ 'ALL', 'QUEUED' ])
-def list_validations(valstatus, what, extended=False):
-  if what == what_val.ALL:
-    vals = valstatus.get_validations()
-  elif what == what_val.QUEUED:
-    vals = valstatus.get_validations(status=ValStatus.status.NOT_RUNNING)
-  else:
+def list_validations(valstatus, what, extended=False, filters={}, limit=None, format='table'):
+  '''Lists validations matching the given filters (see
+     ValStatus.iter_validations()). At most limit validations are shown: if
+     there are more, the cursor of the next page is printed.
+  '''
+  log = get_logger()
+  filters = filters.copy()
+  if what == what_val.QUEUED:
+    filters['statuses'] = [ ValStatus.status.NOT_RUNNING ]
+  elif what != what_val.ALL:
     assert False, 'invalid parameter'
-  if extended:
+  if limit is not None:
+    # fetch one more to know whether there is a next page
+    vals = valstatus.iter_validations(limit=limit+1, **filters)
+  else:
+    vals = valstatus.iter_validations(**filters)
+  state = { 'count': 0, 'last': None, 'more': False }
+  def paginate(vals):
+    for v in vals:
+      if limit is not None and state['count'] == limit:
+        state['more'] = True
+        break
+      state['count'] += 1
+      state['last'] = v
+      yield v
+  vals = paginate(vals)
+
+  if format != 'table':
+    from recordwriter import RecordWriter
+    out = RecordWriter(fmt=format, fields=[ 'id', 'session', 'tarball', 'software', 'version', 'platform', 'arch',
+      'status', 'inserted', 'started', 'ended', 'duration' ])
+    for v in vals:
+      times = []
+      for ts in [ v.inserted, v.started, v.ended ]:
+        if ts is None:
+          times.append(None)
+        else:
+          times.append( ts.get_formatted_str(TimeStamp.datefmt.ISO8601) )
+      if v.started is not None and v.ended is not None:
+        duration = (v.ended-v.started) / 1000000.0
+      else:
+        duration = None
+      out.write([ v.id, v.get_session_tag(), v.package.tarball, v.package.software, v.package.version,
+        v.package.platform, v.package.arch, ValStatus.status.getk(v.status) ] + times + [ duration ])
+  elif extended:
     for v in vals:
       print v
   else:
+    from prettytable import PrettyTable
     tab = PrettyTable( [ 'Software', 'Platform', 'Arch', 'Status', 'Started', 'Ended', 'Duration' ] )
     for k in tab.align.keys():
       tab.align[k] = 'l'
@@ -311,14 +731,11 @@ def list_validations(valstatus, what, extended=False):
       elif v.ended is not None:
         started = v.started.get_formatted_str(TimeStamp.datefmt.NO_USEC)
         ended = v.ended.get_formatted_str(TimeStamp.datefmt.NO_USEC)
-        delta = str(v.ended-v.started)
+        delta = TimeStamp.format_delta(v.ended-v.started)
       else:
         started = v.started.get_formatted_str(TimeStamp.datefmt.NO_USEC)
         ended = '-'
-        delta = str(TimeStamp()-v.started)
-      idx = delta.rfind('.')
-      if idx > 0:
-        delta = delta[0:idx]
+        delta = TimeStamp.format_delta(TimeStamp()-v.started)
       tab.add_row([
         v.package.software,
         v.package.platform,
@@ -330,60 +747,370 @@ def list_validations(valstatus, what, extended=False):
       ])
     print tab
 
+  if state['more']:
+    log.info('more validations available: next page with --after=%s' % format_page_cursor(state['last']))
+  return True
+
+
+def show_stats(valstatus, filters={}, format='table'):
+  '''Shows, for each phase of the validations (queue, fetch, modulefile,
+     launch, poll, poll_failed, run), how many times it was timed and its mean, median,
+     95th percentile and max duration in seconds. Only the time window and the
+     arch and platform filters apply.
+  '''
+  stats = valstatus.get_phase_stats(since=filters.get('since'), until=filters.get('until'),
+    arch=filters.get('arch'), platform=filters.get('platform'))
+  if format != 'table':
+    from recordwriter import RecordWriter
+    out = RecordWriter(fmt=format, fields=[ 'phase', 'count', 'mean', 'p50', 'p95', 'max' ])
+    for st in stats:
+      out.write([ st['phase'], st['count'], st['mean'], st['p50'], st['p95'], st['max'] ])
+  else:
+    from prettytable import PrettyTable
+    tab = PrettyTable( [ 'Phase', 'Count', 'Mean', 'p50', 'p95', 'Max' ] )
+    for k in tab.align.keys():
+      tab.align[k] = 'r'
+    tab.align['Phase'] = 'l'
+    tab.padding_width = 1
+    for st in stats:
+      tab.add_row([ st['phase'], st['count'] ] + [ '%.3f' % st[k] for k in [ 'mean', 'p50', 'p95', 'max' ] ])
+    print tab
   return True
 
 
-def start_next_queued_validation(valstatus, baseurl, unpackdir=None, modulefile=None, unpackcmd=None, relvalcmd=None, mail=None, dryrun=False):
+def parse_slots(slots):
+  '''Parses a string in the form "name1:n1,name2:n2" into a dictionary mapping
+     each name to its number of slots.
+  '''
+  slotsdict = {}
+  for s in slots.split(','):
+    s = s.strip()
+    if s == '':
+      continue
+    name, n = s.rsplit(':', 1)
+    slotsdict[name.strip()] = int(n) # ValueError
+  return slotsdict
+
+
+def get_package_varsubst(pack):
+  return {
+    'SOFTWARE': pack.software,
+    'PLATFORM': pack.platform,
+    'ARCH': pack.arch,
+    'VERSION': pack.version,
+    'URL': pack.get_url()
+  }
+
+
+def get_free_mb(path):
+  '''Returns the free space in MB on the filesystem where path is, or would
+     be created.
+  '''
+  while not os.path.exists(path):
+    path = os.path.dirname(path)
+  st = os.statvfs(path)
+  return st.f_bavail * st.f_frsize / 1048576
+
+
+def get_disk_usage(path):
+  '''Returns the disk space in bytes used by the given directory tree.'''
+  total = 0
+  for root, dirs, files in os.walk(path):
+    for f in dirs + files:
+      try:
+        total += os.lstat( os.path.join(root, f) ).st_blocks * 512
+      except OSError:
+        pass
+  return total
+
+
+def get_unpack_lock(lockdir, pack):
+  return NamedLock(lockdir=lockdir, name='unpack-%s' % pack.tarball)
+
+
+def mark_package_fetched(valstatus, pack, disk_size):
+  pack.fetched = True
+  pack.disk_size = disk_size
+  pack.last_used = TimeStamp()
+  valstatus.update_package(pack)
+
+
+def evict_packages(valstatus, unpackdir=None, modulefile=None, quota=0, dryrun=False, lockdir=None):
+  '''Removes the unpacked trees of the least recently used packages until the
+     disk space used by all unpacked packages is below the quota (in MB, 0
+     means no quota), and the modulefiles we wrote for them: the ones of
+     packages fetched only as dependencies belong to the site. Packages needed
+     by queued, starting or running validations are never evicted, and
+     neither are packages being unpacked right now.
+  '''
   log = get_logger()
-  for p in [unpackdir, modulefile, unpackcmd, relvalcmd, mail]:
+  for p in [unpackdir, modulefile, lockdir]:
     assert p is not None, 'invalid parameters'
+  if quota <= 0:
+    log.debug('no disk quota for unpacked packages: nothing to evict')
+    return True
 
-  v = valstatus.get_oldest_queued_validation()
-  if v is None:
-    log.info('no validations queued: nothing to do')
+  total = 0
+  for p in valstatus.get_packages(fetched=True):
+    if p.disk_size is None:
+      p.disk_size = get_disk_usage( string.Template(unpackdir).safe_substitute(get_package_varsubst(p)) )
+      if not dryrun:
+        valstatus.update_package(p)
+    total += p.disk_size
+  limit = quota * 1048576
+  log.info('unpacked packages use %.1f MB out of %d MB' % (total / 1048576., quota))
+  if total <= limit:
     return True
-  else:
-    startedts = TimeStamp()
-    varsubst = {
-        'PLATFORM': v.package.platform,
-        'ARCH': v.package.arch,
-        'VERSION': v.package.version,
-        'MODULEFILE_DEPS': ' '.join(v.package.deps).replace(v.package.org+'@', '').replace('::', '/'),
-        'URL': v.package.get_url(),
-        'SESSIONTAG': v.get_session_tag()
-    }
 
+  for p, validated in valstatus.get_evictable_packages():
+    if total <= limit:
+      break
+    varsubst = get_package_varsubst(p)
     destdir = string.Template(unpackdir).safe_substitute(varsubst)
-    varsubst['DESTDIR'] = destdir
-    destdirexists = os.path.isdir(destdir)
-    if v.package.fetched and destdirexists:
-      log.info('package already unpacked in %s' % destdir)
+    if validated:
+      destmod = string.Template(modulefile).safe_substitute(varsubst)
     else:
-      if not destdirexists:
-        os.makedirs(destdir) # OSError
-      cmd = string.Template(unpackcmd).safe_substitute(varsubst)
-      log.info('downloading and unpacking %s (might take time)' % varsubst['URL'])
+      destmod = None
+    size = p.disk_size or 0
+    lock = get_unpack_lock(lockdir, p)
+    if not lock.acquire(exclusive=True, timeout=0):
+      log.debug('%s is being unpacked: not evicting it' % p.get_package_name())
+      continue
+    try:
+      log.info('evicting %s (%.1f MB, last used: %s)' % (p.get_package_name(), size / 1048576., p.last_used))
       if dryrun:
-        log.info('DRY RUN: not running command %s' % cmd)
-        v.package.fetched = True
+        log.info('DRY RUN: not removing %s and modulefile %s' % (destdir, destmod or '<not ours>'))
       else:
-        try:
-          run_command(cmd, nonzero_raise=True)
-        except OSError:
-          log.error('error unpacking: cleaning up %s' % destdir)
-          shutil.rmtree(destdir)
-          raise
-        log.info('unpacked in %s successfully' % varsubst['DESTDIR'])
-        v.package.fetched = True
-        valstatus.update_package(v.package)
-
-    destmod = string.Template(modulefile).safe_substitute(varsubst)
-    destmoddir = os.path.dirname(destmod)
-    if not dryrun and not os.path.isdir(destmoddir):
-      os.makedirs(destmoddir) # OSError
-
-    log.debug('preparing module file %s' % destmod)
-    destmodcontent = string.Template('''#%Module1.0
+        import shutil
+        shutil.rmtree(destdir, ignore_errors=True)
+        if destmod is not None and os.path.isfile(destmod):
+          os.remove(destmod)
+        p.fetched = False
+        p.disk_size = None
+        valstatus.update_package(p)
+    finally:
+      lock.release()
+    total -= size
+
+  if total > limit:
+    log.warning('unpacked packages still use %.1f MB: all others are in use' % (total / 1048576.))
+    return False
+  return True
+
+
+def fetch_package(pack, destdir, unpackcmd, varsubst, dryrun=False, fetcher=None):
+  '''Downloads and unpacks the given package in destdir, unless it has been
+     fetched already. The built-in fetcher is used, unless a shell unpackcmd
+     is given. Returns True if the package had to be fetched: updating the
+     database is up to the caller. Raises OSError, IOError or PackFetcherError
+     on failure.
+  '''
+  log = get_logger()
+  destdirexists = os.path.isdir(destdir)
+  if pack.fetched and destdirexists:
+    log.info('package already unpacked in %s' % destdir)
+    return False
+  log.info('downloading and unpacking %s (might take time)' % varsubst['URL'])
+
+  if not unpackcmd:
+    if dryrun:
+      log.info('DRY RUN: not downloading %s' % varsubst['URL'])
+    else:
+      if fetcher is None:
+        from fetcher import PackFetcher
+        fetcher = PackFetcher()
+      fetcher.fetch(varsubst['URL'], destdir)
+      log.info('unpacked in %s successfully' % destdir)
+    return True
+
+  if not destdirexists and not dryrun:
+    os.makedirs(destdir) # OSError
+  cmd = string.Template(unpackcmd).safe_substitute(varsubst)
+  if dryrun:
+    log.info('DRY RUN: not running command %s' % cmd)
+  else:
+    try:
+      run_command(cmd, nonzero_raise=True)
+    except OSError:
+      log.error('error unpacking: cleaning up %s' % destdir)
+      import shutil
+      shutil.rmtree(destdir)
+      raise
+    log.info('unpacked in %s successfully' % destdir)
+  return True
+
+
+def fetch_packages(valstatus, packs, unpackdir=None, modulefile=None, unpackcmd=None, workers=1, minfree=0, quota=0,
+  dryrun=False, fetcher=None, lockdir=None, wait=False):
+  '''Downloads and unpacks the given packages in parallel, with at most
+     workers concurrent transfers. No transfer is started when less than
+     minfree MB are left on the destination filesystem. Packages being
+     unpacked by another process are skipped, or waited for if wait is set.
+     Returns False if any package could not be fetched.
+  '''
+  log = get_logger()
+  jobs = []
+  locks = {}
+  for p in packs:
+    lock = get_unpack_lock(lockdir, p)
+    if not lock.acquire(exclusive=True, timeout=None if wait else 0):
+      log.debug('%s is being unpacked by another process: skipping' % p.tarball)
+      continue
+    valstatus.reload_package(p)
+    varsubst = get_package_varsubst(p)
+    destdir = string.Template(unpackdir).safe_substitute(varsubst)
+    if p.fetched and os.path.isdir(destdir):
+      lock.release()
+      continue
+    locks[p.tarball] = lock
+    varsubst['DESTDIR'] = destdir
+    jobs.append( (p, destdir, varsubst) )
+  if len(jobs) == 0:
+    return True
+  log.info('fetching %d package(s) with %d concurrent transfer(s)' % (len(jobs), workers))
+
+  ok = True
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool( max(1, min(workers, len(jobs))) )
+  try:
+    evict_packages(valstatus, unpackdir=unpackdir, modulefile=modulefile, quota=quota, dryrun=dryrun, lockdir=lockdir)
+
+    def fetch(job):
+      p, destdir, varsubst = job
+      free = get_free_mb(destdir)
+      if free < minfree:
+        return (p, 'only %d MB left on disk (need %d MB)' % (free, minfree), None, None)
+      started = TimeStamp()
+      try:
+        fetch_package(p, destdir, unpackcmd, varsubst, dryrun=dryrun, fetcher=fetcher)
+      except Exception as e:
+        return (p, str(e), None, None)
+      timing = (None, p, 'fetch', started, started.get_elapsed_sec())
+      if dryrun:
+        return (p, None, None, timing)
+      return (p, None, get_disk_usage(destdir), timing)
+
+    # transfers happen in the workers, database updates only from here
+    for p, err, disk_size, timing in pool.imap_unordered(fetch, jobs):
+      if err is not None:
+        log.warning('cannot fetch %s: %s' % (p.tarball, err))
+        ok = False
+      elif not dryrun:
+        mark_package_fetched(valstatus, p, disk_size)
+        valstatus.add_timings([ timing ])
+      locks.pop(p.tarball).release()
+  finally:
+    pool.close()
+    pool.join()
+    for lock in locks.values():
+      lock.release()
+  return ok
+
+
+def plan_dependency_fetches(valstatus, packs):
+  '''Returns the distinct dependencies, direct or not, of the given packages
+     which are not unpacked yet, as a list of batches in topological order:
+     the dependencies of the packages in a batch are all in previous batches,
+     so that the packages of each batch can be fetched in parallel.
+     Dependencies which are not known packages are assumed to be provided
+     otherwise, with a warning.
+  '''
+  log = get_logger()
+  deps, edges, missing = valstatus.get_dependency_graph([ p.id for p in packs ])
+  for package_id, name in missing:
+    log.warning('dependency %s of package %d is not a known package: assuming it is installed' % (name, package_id))
+  batches = []
+  done = set()
+  todo = set(deps)
+  while todo:
+    batch = [ i for i in todo if edges[i] <= done ]
+    if not batch:
+      log.warning('circular dependencies between %s: fetching them in any order' % \
+        ', '.join(sorted([ deps[i].get_package_name() for i in todo ])))
+      batch = list(todo)
+    done.update(batch)
+    todo.difference_update(batch)
+    batch = [ deps[i] for i in sorted(batch) if not deps[i].fetched ]
+    if batch:
+      batches.append(batch)
+  log.debug('%d dependencies to fetch in %d batch(es)' % (sum([ len(b) for b in batches ]), len(batches)))
+  return batches
+
+
+def prefetch_packages(valstatus, unpackdir=None, modulefile=None, unpackcmd=None, count=1, workers=1, minfree=0, quota=0,
+  dryrun=False, fetcher=None, lockdir=None):
+  '''Downloads and unpacks in parallel the dependencies of all the queued
+     validations, each of them once, then the packages of the next count
+     queued validations, so that starting them does not need to wait for the
+     transfers. See fetch_packages() for the other parameters.
+  '''
+  log = get_logger()
+  for p in [unpackdir, modulefile, lockdir]:
+    assert p is not None, 'invalid parameters'
+  if count <= 0:
+    return True
+
+  ok = True
+  params = { 'unpackdir': unpackdir, 'modulefile': modulefile, 'unpackcmd': unpackcmd, 'workers': workers,
+    'minfree': minfree, 'quota': quota, 'dryrun': dryrun, 'fetcher': fetcher, 'lockdir': lockdir }
+  for batch in plan_dependency_fetches(valstatus, valstatus.get_queued_packages()):
+    ok = fetch_packages(valstatus, batch, **params) and ok
+  packs = valstatus.get_queued_packages(fetched=False, limit=count)
+  if len(packs) == 0:
+    log.info('no queued packages to prefetch')
+    return ok
+  return fetch_packages(valstatus, packs, **params) and ok
+
+
+def start_validation(valstatus, v, unpackdir, modulefile, unpackcmd, relvalcmd, dryrun=False, fetcher=None, quota=0,
+  lockdir=None):
+  '''Downloads and unpacks the dependencies and the package of the given
+     validation, which must have been claimed already, writes its modulefile
+     and launches it. If any of them is being unpacked by another process,
+     waits for it. The duration of each phase is recorded.
+  '''
+  log = get_logger()
+  timings = [ (v, v.package, 'queue', v.inserted, (v.started-v.inserted) / 1000000.0) ]
+  varsubst = get_package_varsubst(v.package)
+  varsubst['MODULEFILE_DEPS'] = ' '.join(v.package.deps or []).replace(v.package.org+'@', '').replace('::', '/')
+  varsubst['SESSIONTAG'] = v.get_session_tag()
+
+  # dependencies first: usually they have been prefetched already
+  for batch in plan_dependency_fetches(valstatus, [ v.package ]):
+    if not fetch_packages(valstatus, batch, unpackdir=unpackdir, modulefile=modulefile, unpackcmd=unpackcmd,
+      quota=quota, dryrun=dryrun, fetcher=fetcher, lockdir=lockdir, wait=True):
+      raise IOError('cannot fetch the dependencies of %s' % v.package.get_package_name())
+  if not dryrun:
+    valstatus.touch_packages( valstatus.get_dependency_graph([ v.package.id ])[0].keys() )
+
+  destdir = string.Template(unpackdir).safe_substitute(varsubst)
+  varsubst['DESTDIR'] = destdir
+  lock = get_unpack_lock(lockdir, v.package)
+  lock.acquire(exclusive=True)
+  try:
+    valstatus.reload_package(v.package)
+    if not (v.package.fetched and os.path.isdir(destdir)):
+      evict_packages(valstatus, unpackdir=unpackdir, modulefile=modulefile, quota=quota, dryrun=dryrun, lockdir=lockdir)
+    started = TimeStamp()
+    if fetch_package(v.package, destdir, unpackcmd, varsubst, dryrun=dryrun, fetcher=fetcher):
+      timings.append( (v, v.package, 'fetch', started, started.get_elapsed_sec()) )
+      v.package.fetched = True
+      if not dryrun:
+        mark_package_fetched(valstatus, v.package, get_disk_usage(destdir))
+    elif not dryrun:
+      v.package.last_used = TimeStamp()
+      valstatus.update_package(v.package)
+  finally:
+    lock.release()
+
+  started = TimeStamp()
+  destmod = string.Template(modulefile).safe_substitute(varsubst)
+  destmoddir = os.path.dirname(destmod)
+  if not dryrun and not os.path.isdir(destmoddir):
+    os.makedirs(destmoddir) # OSError
+
+  log.debug('preparing module file %s' % destmod)
+  destmodcontent = string.Template('''#%Module1.0
 proc ModulesHelp { } {
   global version
   puts stderr "This module is for an AliRoot version to be validated."
@@ -399,44 +1126,174 @@ prepend-path PATH $::env(ALICE_ROOT)/bin/tgt_$::env(ALICE_TARGET_EXT)
 prepend-path LD_LIBRARY_PATH $::env(ALICE_ROOT)/lib/tgt_$::env(ALICE_TARGET_EXT)
 ''').safe_substitute(varsubst)
 
-    if not dryrun:
-      with open(destmod, 'w') as f:
-        f.write(destmodcontent)
-      log.info('modulefile %s written' % destmod)
-    else:
-      log.info('DRY RUN: not writing modulefile, outputting it on screen')
-    print destmodcontent
+  if not dryrun:
+    with open(destmod, 'w') as f:
+      f.write(destmodcontent)
+    log.info('modulefile %s written' % destmod)
+  else:
+    log.info('DRY RUN: not writing modulefile, outputting it on screen')
+  print destmodcontent
+  timings.append( (v, v.package, 'modulefile', started, started.get_elapsed_sec()) )
+
+  cmd = string.Template(relvalcmd).safe_substitute(varsubst)
+  if not dryrun:
+    log.info('running validation command')
+    started = TimeStamp()
+    run_command(cmd, nonzero_raise=True)
+    timings.append( (v, v.package, 'launch', started, started.get_elapsed_sec()) )
+  else:
+    log.info('DRY RUN: not running validation command')
+
+  v.status = ValStatus.status.RUNNING
+  varsubst['VALIDATION_STR'] = str(v)
+  mails = [ format_mail(
+    subject='[AliRelVal] Validation started: $VERSION',
+    message='The following validation has started:\n\n$VALIDATION_STR',
+    varsubst=varsubst ) ]
+  if not dryrun:
+    valstatus.update_validation(v, mails=mails, timings=timings)
+  else:
+    log.info('DRY RUN: not queuing notification email')
 
-    cmd = string.Template(relvalcmd).safe_substitute(varsubst)
-    if not dryrun:
-      log.info('running validation command')
-      run_command(cmd, nonzero_raise=True)
-    else:
-      log.info('DRY RUN: not running validation command')
 
-    v.started = startedts
-    v.status = ValStatus.status.RUNNING
-    if not dryrun:
-      valstatus.update_validation(v)
+def requeue_validation(valstatus, v, dryrun=False):
+  v.status = ValStatus.status.NOT_RUNNING
+  v.started = None
+  if not dryrun:
+    valstatus.update_validation(v)
 
-    varsubst['VALIDATION_STR'] = str(v)
-    send_mail(
-      host=mail['host'],
-      port=mail['port'],
-      sender=mail['from'],
-      to=mail['to'].split(','),
-      subject='[AliRelVal] Validation started: $VERSION',
-      message='The following validation has started:\n\n$VALIDATION_STR',
-      varsubst=varsubst )
 
-  return True
+def fail_validation(valstatus, v, error, dryrun=False):
+  '''Marks a validation which cannot be started as DONE_FAIL, notifying it.'''
+  v.status = ValStatus.status.DONE_FAIL
+  v.ended = TimeStamp()
+  varsubst = get_package_varsubst(v.package)
+  varsubst['ERROR'] = error
+  varsubst['VALIDATION_STR'] = str(v)
+  mails = [ format_mail(
+    subject='[AliRelVal] Validation failed to start: $VERSION',
+    message='''Validation for $VERSION could not be started:
+
+  $ERROR
+
+Validation details:
+
+$VALIDATION_STR''',
+    varsubst=varsubst ) ]
+  if not dryrun:
+    valstatus.update_validation(v, mails=mails)
+
+
+def start_queued_validations(valstatus, baseurl, unpackdir=None, modulefile=None, unpackcmd=None, relvalcmd=None,
+  maxrunning=None, archslots='', platformslots='', limit=None, prefetch=0, prefetchworkers=1, prefetchminfree=0, dryrun=False,
+  fetcher=None, quota=0, lockdir=None):
+  '''Starts as many queued validations as there are free slots, oldest first.
+     Validations failing to start because of a network, disk or command error
+     are put back in the queue, the others are marked as failed. The packages of
+     the next prefetch queued validations are then fetched in advance.
+  '''
+  log = get_logger()
+  for p in [unpackdir, modulefile, relvalcmd]:
+    assert p is not None, 'invalid parameters'
+  from fetcher import PackFetcherError
+  if maxrunning is not None and maxrunning <= 0:
+    maxrunning = None
+
+  vals = valstatus.claim_queued_validations(maxrunning=maxrunning, archslots=parse_slots(archslots),
+    platformslots=parse_slots(platformslots), limit=limit, dryrun=dryrun)
+  if len(vals) == 0:
+    log.info('no validations queued or no free slots: nothing to start')
+  else:
+    log.info('starting %d validation(s)' % len(vals))
+
+  ok = True
+  pending = list(vals)
+  try:
+    while pending:
+      v = pending[0]
+      try:
+        start_validation(valstatus, v, unpackdir=unpackdir, modulefile=modulefile, unpackcmd=unpackcmd,
+          relvalcmd=relvalcmd, dryrun=dryrun, fetcher=fetcher, quota=quota, lockdir=lockdir)
+      except (EnvironmentError, PackFetcherError) as e:
+        log.error('cannot start validation %s: %s: putting it back in the queue' % (v.get_session_tag(), e))
+        ok = False
+        requeue_validation(valstatus, v, dryrun=dryrun)
+      except Exception as e:
+        # not a network, disk or command failure: it would fail again every time
+        log.error('cannot start validation %s: %s: marking it as failed' % (v.get_session_tag(), e))
+        for l in traceback.format_exc().split('\n'):
+          if l != '':
+            log.debug(l)
+        ok = False
+        fail_validation(valstatus, v, str(e), dryrun=dryrun)
+      pending.pop(0)
+  finally:
+    # interrupted (e.g. KeyboardInterrupt): claimed validations must not stay STARTING
+    if pending:
+      log.warning('interrupted: putting %d claimed validation(s) back in the queue' % len(pending))
+      for v in pending:
+        requeue_validation(valstatus, v, dryrun=dryrun)
+
+  if prefetch > 0:
+    prefetch_packages(valstatus, unpackdir=unpackdir, modulefile=modulefile, unpackcmd=unpackcmd, count=prefetch,
+      workers=prefetchworkers, minfree=prefetchminfree, quota=quota, dryrun=dryrun, fetcher=fetcher, lockdir=lockdir)
+  return ok
+
+
+def start_next_queued_validation(valstatus, baseurl, unpackdir=None, modulefile=None, unpackcmd=None, relvalcmd=None, dryrun=False,
+  fetcher=None, quota=0, lockdir=None):
+  return start_queued_validations(valstatus, baseurl, unpackdir=unpackdir, modulefile=modulefile, unpackcmd=unpackcmd,
+    relvalcmd=relvalcmd, limit=1, dryrun=dryrun, fetcher=fetcher, quota=quota, lockdir=lockdir)
+
+
+def get_batch_status(batchstatuscmd, statusmap, sessiontags, timeout=None):
+  '''Queries the status of all the given sessions with a single invocation of
+     batchstatuscmd. Session tags are passed both as $SESSIONTAGS and on stdin,
+     one per line. The command outputs one "SESSIONTAG STATUS" line per
+     session, where STATUS is either a status name (e.g. DONE_OK) or one of the
+     configured status codes. Returns a dict mapping session tags to status
+     names: sessions whose status is unknown are not in the dict.
+  '''
+  log = get_logger()
+  cmd = string.Template(batchstatuscmd).safe_substitute({ 'SESSIONTAGS': ' '.join(sessiontags) })
+  log.debug('querying status for %d session(s) at once' % len(sessiontags))
+  rc, out = run_command_output(cmd, input=''.join([ t+'\n' for t in sessiontags ]), timeout=timeout)
+  statuses = {}
+  if rc is None:
+    log.warning('timeout querying status of all sessions: status unknown')
+    return statuses
+  elif rc != 0:
+    log.warning('batch status command returned %d: status unknown' % rc)
+    return statuses
+  for l in out.split('\n'):
+    a = l.split()
+    if len(a) == 0:
+      continue
+    elif len(a) != 2:
+      log.warning('quietly skipping unparsable status line: %s' % l)
+      continue
+    tag, st = a
+    try:
+      if st.isdigit():
+        st = statusmap.getk(int(st))
+      else:
+        statusmap.getv(st)
+      statuses[tag] = st
+    except Exception:
+      log.warning('unknown status %s returned for %s' % (st, tag))
+  return statuses
 
 
-def refresh_validations(valstatus, statuscmd=None, statusmap=None, resultsurl=None, mail=None, dryrun=False):
+def refresh_validations(valstatus, statuscmd=None, statusmap=None, resultsurl=None, dryrun=False, workers=1, timeout=None, batchstatuscmd=None):
   log = get_logger()
-  for p in [statuscmd, statusmap, resultsurl, mail]:
+  for p in [statuscmd, statusmap, resultsurl]:
     assert p is not None, 'invalid parameters'
-  for v in valstatus.get_validations(status=ValStatus.status.RUNNING):
+  if timeout is not None and timeout <= 0:
+    timeout = None
+
+  vals = valstatus.get_validations(status=ValStatus.status.RUNNING)
+  varsubsts = []
+  for v in vals:
     varsubst = {
         'PLATFORM': v.package.platform,
         'ARCH': v.package.arch,
@@ -444,16 +1301,48 @@ def refresh_validations(valstatus, statuscmd=None, statusmap=None, resultsurl=No
         'SESSIONTAG': v.get_session_tag()
     }
     varsubst['RESULTS_URL'] = string.Template(resultsurl).safe_substitute(varsubst)
-    cmd = string.Template(statuscmd).safe_substitute(varsubst)
-    log.debug('querying status for %s' % varsubst['SESSIONTAG'])
-    rc = run_command(cmd)
+    varsubsts.append(varsubst)
+
+  # one status string per validation, None if unknown, and when it was queried
+  status_strs = []
+  poll_times = []
+  if batchstatuscmd and len(vals) > 0:
+    started = TimeStamp()
+    statuses = get_batch_status(batchstatuscmd, statusmap, [ vs['SESSIONTAG'] for vs in varsubsts ], timeout=timeout)
+    poll_times = [ (started, started.get_elapsed_sec()) ] * len(vals)
+    for varsubst in varsubsts:
+      if varsubst['SESSIONTAG'] not in statuses:
+        log.warning('no status returned for %s: skipping' % varsubst['SESSIONTAG'])
+      status_strs.append( statuses.get(varsubst['SESSIONTAG']) )
+  else:
+    # status commands run in parallel; results are applied in order from here
+    cmds = []
+    for varsubst in varsubsts:
+      log.debug('querying status for %s' % varsubst['SESSIONTAG'])
+      cmds.append( string.Template(statuscmd).safe_substitute(varsubst) )
+    rcs = run_commands(cmds, workers=workers, timeout=timeout)
+    for varsubst, (rc, started, duration) in zip(varsubsts, rcs):
+      poll_times.append( (started, duration) )
+      if rc is None:
+        log.warning('timeout checking status of %s: status unknown, skipping' % varsubst['SESSIONTAG'])
+        status_strs.append(None)
+        continue
+      try:
+        # map return code (e.g. 101) to status string (e.g. 'NOT_RUNNING')
+        status_strs.append( statusmap.getk(rc) )
+      except Exception:
+        log.warning('unknown value (%d) returned when checking status of %s: skipping' % (rc, varsubst['SESSIONTAG']))
+        status_strs.append(None)
 
-    try:
-      # map return code (e.g. 101) to status string (e.g. 'NOT_RUNNING')
-      status_str = statusmap.getk(rc)
-    except Exception:
-      log.warning('unknown value (%d) returned when checking status of %s: skipping' % (rc, varsubst['SESSIONTAG']))
+  # all changes and their notifications are written in a single transaction
+  changed = []
+  timings = []
+  for v, varsubst, status_str, (started, duration) in zip(vals, varsubsts, status_strs, poll_times):
+
+    if status_str is None:
+      timings.append( (v, v.package, 'poll_failed', started, duration) )
       continue
+    timings.append( (v, v.package, 'poll', started, duration) )
 
     status_num = ValStatus.status.getv(status_str)
 
@@ -470,20 +1359,16 @@ def refresh_validations(valstatus, statuscmd=None, statusmap=None, resultsurl=No
 
       v.ended = TimeStamp()
       v.status = status_num
-      if not dryrun:
-        valstatus.update_validation(v)
-      else:
-        log.info('DRY RUN: not updating validation status')
-
       varsubst['STATUS_STR'] = status_str
-      varsubst['VALIDATION_STR'] = str(v)
-      send_mail(
-        host=mail['host'],
-        port=mail['port'],
-        sender=mail['from'],
-        to=mail['to'].split(','),
-        subject='[AliRelVal] Validation $STATUS_STR: $VERSION',
-        message='''Validation for $VERSION: $STATUS_STR.
+      changed.append( (v, varsubst) )
+      timings.append( (v, v.package, 'run', v.started, (v.ended-v.started) / 1000000.0) )
+
+  mails = []
+  for v, varsubst in changed:
+    varsubst['VALIDATION_STR'] = str(v)
+    mails.append( format_mail(
+      subject='[AliRelVal] Validation $STATUS_STR: $VERSION',
+      message='''Validation for $VERSION: $STATUS_STR.
 
 Find the results here:
 
@@ -492,73 +1377,415 @@ Find the results here:
 Validation details:
 
 $VALIDATION_STR''',
-        varsubst=varsubst )
+      varsubst=varsubst ) )
+
+  if not dryrun:
+    valstatus.update_validations([ v for v, varsubst in changed ], mails=mails, timings=timings)
+  elif changed:
+    log.info('DRY RUN: not updating validation status nor queuing notification emails')
 
   return True
 
 
-def send_mail(host, port, sender, to, subject, message, varsubst={}):
+def format_mail(subject, message, varsubst={}):
+  '''Returns a (subject, body) tuple to be put in the outbox.'''
+  return ( string.Template(subject).safe_substitute(varsubst), string.Template(message).safe_substitute(varsubst) )
+
+
+def flush_outbox(valstatus, mail, dryrun=False):
+  '''Sends the notification emails waiting in the outbox, all through a
+     single SMTP session. Mails failing are retried at the next flush after
+     an exponential backoff, and given up after mail['maxattempts'] failures.
+     If mail['digest'] is set, all pending mails are sent as a single one.
+  '''
+  import socket
+  from smtplib import SMTP, SMTPException, SMTPServerDisconnected
   log = get_logger()
-  log.debug('sending notification email to recipients: %s' % ','.join(to))
-  message = '''From: %s
-To: %s
-Subject: %s
+  pending = valstatus.get_pending_mails(maxattempts=mail['maxattempts'])
+  if len(pending) == 0:
+    log.debug('no notification emails to send')
+    return True
+
+  if mail['digest'] and len(pending) > 1:
+    body = '\n\n'.join([ '=== %s ===\n\n%s' % (m['subject'], m['body']) for m in pending ])
+    batches = [ (pending, '[AliRelVal] %d notifications' % len(pending), body) ]
+  else:
+    batches = [ ([ m ], m['subject'], m['body']) for m in pending ]
 
-%s''' % (sender, ', '.join(to), subject, message)
-  m = string.Template(message).safe_substitute(varsubst)
+  if dryrun:
+    for mails, subject, body in batches:
+      log.info('DRY RUN: not sending notification email: %s' % subject)
+    return True
+
+  to = mail['to'].split(',')
+  def failed(mails, error):
+    valstatus.mark_mails_failed([ m['mail_id'] for m in mails ], error, mail['retrydelay'])
+    for m in mails:
+      if m['attempts']+1 >= mail['maxattempts']:
+        log.error('giving up sending notification email "%s" after %d attempts' % (m['subject'], m['attempts']+1))
+
+  log.debug('sending %d notification email(s) to recipients: %s' % (len(batches), ','.join(to)))
+  try:
+    mailer = SMTP(mail['host'], mail['port'], timeout=mail['timeout'])
+  except (SMTPException, socket.error) as e:
+    log.error('cannot connect to mail server %s:%d: %s' % (mail['host'], mail['port'], e))
+    failed(pending, str(e))
+    return False
+
+  ok = True
   try:
-    mailer = SMTP(host, port)
-    mailer.sendmail(sender, to, m)
-  except Exception as e:
-    log.error('cannot send notification email: %s' % e)
-  log.info('notification email sent')
+    for i, (mails, subject, body) in enumerate(batches):
+      message = 'From: %s\nTo: %s\nSubject: %s\nContent-Type: text/plain; charset=utf-8\n\n%s' % \
+        (mail['from'], ', '.join(to), subject, body)
+      if isinstance(message, unicode):
+        message = message.encode('utf-8')
+      try:
+        mailer.sendmail(mail['from'], to, message)
+      except (SMTPServerDisconnected, socket.error) as e:
+        # connection lost: all remaining mails are retried later
+        log.error('connection to mail server lost: %s' % e)
+        failed([ m for b in batches[i:] for m in b[0] ], str(e))
+        ok = False
+        break
+      except SMTPException as e:
+        log.error('cannot send notification email "%s": %s' % (subject, e))
+        failed(mails, str(e))
+        ok = False
+        continue
+      valstatus.mark_mails_sent([ m['mail_id'] for m in mails ])
+      log.info('notification email sent: %s' % subject)
+  finally:
+    try:
+      mailer.quit()
+    except (SMTPException, socket.error):
+      pass
+  return ok
 
 
-def main(argv):
+# upper bounds of the histogram buckets, in seconds
+metrics_duration_buckets = [ 600, 1800, 3600, 7200, 14400, 28800, 86400, 172800 ]
+metrics_fetch_buckets = [ 5, 15, 30, 60, 120, 300, 600, 1800 ]
 
-  init_logger(log_directory=None, debug=False)
+def format_metrics(valstatus, maxattempts):
+  '''Gathers the metrics from the database with aggregate queries only and
+     returns them in the Prometheus text exposition format.
+  '''
+  lines = []
+  def metric(name, mtype, help, samples):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, mtype))
+    for suffix, labels, value in samples:
+      if labels:
+        labels = '{%s}' % ','.join([ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+          for k, v in labels ])
+      else:
+        labels = ''
+      if isinstance(value, float):
+        value = repr(value)
+      lines.append('%s%s%s %s' % (name, suffix, labels, value))
+  def histogram(name, help, h):
+    samples = [ ('_bucket', [ ('le', b) ], n) for b, n in h['buckets'] ]
+    samples += [ ('_bucket', [ ('le', '+Inf') ], h['count']), ('_sum', None, h['sum']), ('_count', None, h['count']) ]
+    metric(name, 'histogram', help, samples)
+
+  counts = valstatus.get_status_counts()
+  metric('alirelval_validations', 'gauge', 'Validations per status.',
+    [ ('', [ ('status', k) ], counts.get(v, 0)) for k, v in ValStatus.status.getkv() ])
+  oldest = valstatus.get_oldest_inserted(ValStatus.status.NOT_RUNNING)
+  if oldest is not None:
+    age = max(0, oldest.get_elapsed_sec())
+  else:
+    age = 0
+  metric('alirelval_oldest_queued_age_seconds', 'gauge', 'Age of the oldest queued validation, 0 if none.',
+    [ ('', None, float(age)) ])
+  metric('alirelval_running_validations', 'gauge', 'Running validations per arch.',
+    [ ('', [ ('arch', a) ], n) for a, n in sorted(valstatus.get_arch_counts(ValStatus.status.RUNNING).items()) ])
+  histogram('alirelval_validation_duration_seconds', 'Duration of the finished validations.',
+    valstatus.get_duration_histogram(metrics_duration_buckets))
+  histogram('alirelval_fetch_duration_seconds', 'Time spent downloading and unpacking packages.',
+    valstatus.get_duration_histogram(metrics_fetch_buckets, phase='fetch'))
+  metric('alirelval_status_poll_failures_total', 'counter', 'Status queries which timed out or returned an unknown status.',
+    [ ('', None, valstatus.count_timings('poll_failed')) ])
+  outbox = valstatus.get_outbox_counts(maxattempts)
+  metric('alirelval_mails', 'gauge', 'Notification emails in the outbox not sent yet, per state.',
+    [ ('', [ ('state', st) ], outbox[st]) for st in [ 'queued', 'retrying', 'failed' ] ])
+  metric('alirelval_mails_sent_total', 'counter', 'Notification emails sent.', [ ('', None, outbox['sent']) ])
+  return '\n'.join(lines) + '\n'
+
+
+def write_metrics(valstatus, metricsfile, maxattempts, dryrun=False):
+  '''Writes the metrics to metricsfile, for the textfile collector of the
+     Prometheus node exporter. The file is replaced atomically, so that it is
+     never read half-written.
+  '''
   log = get_logger()
-  sys.excepthook = unhandled_exception
+  text = format_metrics(valstatus, maxattempts)
+  if dryrun:
+    log.info('DRY RUN: not writing metrics to %s, outputting them on screen' % metricsfile)
+    sys.stdout.write(text)
+    return True
+  metricsdir = os.path.dirname(metricsfile)
+  if metricsdir != '' and not os.path.isdir(metricsdir):
+    os.makedirs(metricsdir)
+  tmpfile = '%s.%d.tmp' % (metricsfile, os.getpid())
+  with open(tmpfile, 'w') as f:
+    f.write(text)
+  os.rename(tmpfile, metricsfile)
+  log.debug('metrics written to %s' % metricsfile)
+  return True
 
-  debug = False
-  tarball = None
-  extended = False
-  dryrun = False
 
+def find_action(actions, action):
+  '''Finds the action matching the given name, or an unambiguous prefix of it.
+     Returns the action (None if not found) and the list of matching names.
+  '''
+  found = []
+  found_action = None
+  exact_match = False
+  l = len(action)
+  for a in actions:
+    for ali in a['aliases']:
+      if ali == action:
+        found = [ ali ]
+        found_action = a
+        exact_match = True
+        break
+      elif ali[:l] == action:
+        found.insert( bisect.bisect_left(found, ali), ali )
+        found_action = a
+    if exact_match:
+      break
+  return found_action, found
+
+
+def close_stdout():
+  '''Closes stdout, ignoring the error of a pipe closed early. Python 2 does
+     not check the writes done by print: a failed write only shows up when
+     stdout is closed, which must happen here and not at exit.
+  '''
   try:
-    opts, remainder = gnu_getopt(argv, '', [ 'debug', 'tarball=', 'extended', 'dryrun', 'dry-run' ])
-    for o, a in opts:
-      if o == '--debug':
-        debug = True
-      elif o == '--tarball':
-        tarball = a
-      elif o == '--extended':
-        extended = True
-      elif o == '--dryrun' or o == '--dry-run':
-        dryrun = True
-  except GetoptError as e:
-    log.error('error parsing options: %s' % e)
-    return 1
+    sys.stdout.close()
+  except IOError as e:
+    # a failed close has no errno: if stdout is a pipe, it is assumed closed
+    if e.errno != errno.EPIPE and (e.errno or not stat.S_ISFIFO( os.fstat(1).st_mode )):
+      raise
+    get_logger().debug('output pipe closed')
+
+
+def run_action(action, res=None):
+  params = action.get('params')
+  if callable(params):
+    params = params(res)
+  if params is not None:
+    return action['func']( **params )
+  return action['func']()
+
+
+daemon_tasks = [
+  ('update', 'refreshinterval'),
+  ('start-queued-validations', 'startinterval'),
+  ('sync-packages', 'syncinterval'),
+  ('watch-packages', 'watchinterval'),
+  ('gc', 'gcinterval'),
+  ('flush-mail', 'mailinterval'),
+  ('write-metrics', 'metricsinterval')
+]
+def run_daemon(opts):
+  '''Runs the scheduler as a long-running process: each of the daemon_tasks is
+     invoked on its own interval, as configured in the [daemon] section (0
+     disables a task). Configuration is reloaded on SIGHUP. On SIGTERM or
+     SIGINT the running task is completed and the daemon exits. Each task
+     takes the same locks as its command-line counterpart only while running,
+     so that the command line is free to use the database in between.
+  '''
+  log = get_logger()
+  sig = { 'reload': False, 'stop': False }
+  def on_reload(signum, frame):
+    sig['reload'] = True
+  def on_stop(signum, frame):
+    sig['stop'] = True
+  signal.signal(signal.SIGHUP, on_reload)
+  signal.signal(signal.SIGTERM, on_stop)
+  signal.signal(signal.SIGINT, on_stop)
+
+  res = Resources(opts)
+  cfg = res.cfg
+  daemonlock = NamedLock(lockdir=cfg['alirelval']['lockdir'], name='daemon')
+  if not daemonlock.acquire(exclusive=True, timeout=0):
+    log.error('another daemon is running')
+    return False
+  # the pidfile is only used to send signals to the daemon
+  daemonpidfile = cfg['daemon']['pidfile']
+  with open(daemonpidfile, 'w') as pf:
+    pf.write( str(os.getpid())+'\n' )
+
+  actions = get_actions(opts)
+  nextrun = dict( (task, 0) for task, interval in daemon_tasks )
+  log.info('daemon started with pid %d' % os.getpid())
 
   try:
-    action = remainder[0]
-  except IndexError:
-    log.error('please specify an operation, or "help" for a list')
-    return 1
+    while not sig['stop']:
+
+      if sig['reload']:
+        sig['reload'] = False
+        log.info('reloading configuration from %s' % opts['config_file'])
+        res.close()
+        res = Resources(opts)
+        cfg = res.cfg
+
+      for task, interval in daemon_tasks:
+        if sig['stop'] or sig['reload']:
+          break
+        if cfg['daemon'][interval] <= 0 or time.time() < nextrun[task]:
+          continue
+        nextrun[task] = time.time() + cfg['daemon'][interval]
+        log.debug('running task %s' % task)
+        action = find_action(actions, task)[0]
+        held = acquire_locks(cfg['alirelval']['lockdir'], action.get('locks', []), timeout=cfg['alirelval']['locktimeout'])
+        if held is None:
+          log.warning('cannot run task %s now: will retry later' % task)
+          continue
+        try:
+          if not run_action(action, res):
+            log.warning('task %s reported a failure' % task)
+        except Exception as e:
+          log.error('task %s failed: %s' % (task, e))
+          for l in traceback.format_exc().split('\n'):
+            if l != '':
+              log.debug(l)
+        finally:
+          release_locks(held)
+
+      # sleep until the next task is due, waking up on signals
+      due = [ nextrun[task] for task, interval in daemon_tasks if cfg['daemon'][interval] > 0 ]
+      if due:
+        wake = min(due)
+      else:
+        wake = time.time() + 60
+      while not sig['stop'] and not sig['reload'] and time.time() < wake:
+        time.sleep( min(1, max(0, wake-time.time())) )
 
-  # read configuration and re-init logger
-  if debug:
-    init_logger(log_directory=None, debug=True)
-  cfg = init_config( os.path.expanduser('~/.alirelval/alirelval.conf') )
-  init_logger( log_directory=cfg['alirelval']['logdir'], debug=debug )
+  finally:
+    res.close()
+    try:
+      os.remove(daemonpidfile)
+    except OSError:
+      pass
+    daemonlock.release()
 
-  log.debug('alirelval version %s started' % __version__)
+  log.info('daemon exiting')
+  return True
 
-  if not check_lock(cfg['alirelval']['pidfile']):
-    return 1
 
-  # init the database
-  valstatus = ValStatus(dbpath=cfg['alirelval']['dbpath'], baseurl=cfg['alirelval']['packbaseurl'])
+class Resources(object):
+
+  '''What operations need besides their command-line options: the
+     configuration, the database, the package mirrors, the listing cache and
+     the package fetcher.
+     Each of them is set up the first time it is accessed, so that operations
+     only pay for what they use.
+  '''
+
+  def __init__(self, opts):
+    self._opts = opts
+    self._cfg = None
+    self._valstatus = None
+    self._mirrors = None
+    self._listcache = None
+    self._fetcher = None
+
+  @property
+  def cfg(self):
+    if self._cfg is None:
+      start = time.time()
+      self._cfg = init_config(self._opts['config_file'])
+      add_timing('config', start)
+    return self._cfg
+
+  @property
+  def valstatus(self):
+    if self._valstatus is None:
+      cfg = self.cfg
+      start = time.time()
+      self._valstatus = ValStatus(dbpath=cfg['alirelval']['dbpath'], baseurl=cfg['alirelval']['packbaseurl'],
+        busytimeout=cfg['alirelval']['dbbusytimeout'])
+      add_timing('database', start)
+    return self._valstatus
+
+  @property
+  def mirrors(self):
+    '''Package repository mirrors: packbaseurl, which names the packages, and
+       the comma-separated packmirrors.
+    '''
+    if self._mirrors is None:
+      cfg = self.cfg
+      start = time.time()
+      from mirrors import MirrorPool
+      baseurls = [ cfg['alirelval']['packbaseurl'] ] + \
+        [ u.strip() for u in cfg['alirelval']['packmirrors'].split(',') if u.strip() != '' ]
+      self._mirrors = MirrorPool(baseurls=baseurls, timeout=cfg['alirelval']['mirrortimeout'],
+        statefile=cfg['alirelval']['mirrorstate'])
+      add_timing('mirrors', start)
+    return self._mirrors
+
+  @property
+  def listcache(self):
+    '''Cache of remote listings: --refresh forces revalidation, --no-cache
+       skips it (None is returned).
+    '''
+    if self._listcache is None and not self._opts['nocache']:
+      cfg = self.cfg
+      start = time.time()
+      from listcache import ListCache
+      if self._opts['refresh']:
+        ttl = 0
+      else:
+        ttl = cfg['alirelval']['listcachettl']
+      self._listcache = ListCache(cachedir=cfg['alirelval']['listcachedir'], ttl=ttl, mirrors=self.mirrors)
+      add_timing('listcache', start)
+    return self._listcache
+
+  @property
+  def fetcher(self):
+    '''Built-in package fetcher, used unless unpackcmd is set.'''
+    if self._fetcher is None:
+      cfg = self.cfg
+      start = time.time()
+      from fetcher import PackFetcher
+      self._fetcher = PackFetcher(stagingdir=cfg['alirelval']['stagingdir'], mirrors=self.mirrors)
+      add_timing('fetcher', start)
+    return self._fetcher
+
+  def close(self):
+    '''Closes the database and the idle mirror connections, if set up.'''
+    if self._valstatus is not None:
+      self._valstatus.close()
+      self._valstatus = None
+    if self._mirrors is not None:
+      self._mirrors.close()
+
+
+timings = []
+def add_timing(phase, start):
+  '''Records how long a startup phase took, for --timings.'''
+  timings.append( (phase, time.time()-start) )
+
+
+def print_timings():
+  total = 0
+  for phase, secs in timings:
+    sys.stderr.write('%-12s %8.1f ms\n' % (phase, secs*1000))
+    total += secs
+  sys.stderr.write('%-12s %8.1f ms\n' % ('total', total*1000))
+
+
+def get_actions(opts):
+  '''Returns the list of available operations. Each operation declares in
+     needs the resources it uses (see Resources), and the parameters of those
+     needing any are returned by a function taking a Resources object, called
+     only for the operation being run: this way each operation sets up only
+     what it uses.
+  '''
 
   # actions
   actions = [
@@ -567,29 +1794,68 @@ def main(argv):
     {
       'aliases': [ 'list-pub-packages', 'show-pub-packages' ],
       'func': list_packages,
-      'params': {
-        'baseurl': cfg['alirelval']['packbaseurl'],
+      'needs': [ 'cfg', 'mirrors', 'listcache' ],
+      'params': lambda res: {
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
         'what': what_pack.PUBLISHED,
-        'extended': extended
+        'extended': opts['extended'],
+        'listcache': res.listcache,
+        'format': opts['format'],
+        'mirrors': res.mirrors
       }
     },
     {
       'aliases': [ 'list-val-packages', 'show-val-packages' ],
       'func': list_packages,
-      'params': {
-        'baseurl': cfg['alirelval']['packbaseurl'],
+      'needs': [ 'cfg', 'mirrors', 'listcache' ],
+      'params': lambda res: {
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
         'what': what_pack.VALIDATION,
-        'extended': extended
+        'extended': opts['extended'],
+        'listcache': res.listcache,
+        'format': opts['format'],
+        'mirrors': res.mirrors
       }
     },
     {
       'aliases': [ 'list-known-packages', 'show-known-packages', 'list-cached-packages', 'show-cached-packages' ],
       'func': list_packages,
-      'params': {
-        'baseurl': cfg['alirelval']['packbaseurl'],
+      'needs': [ 'cfg', 'valstatus' ],
+      'params': lambda res: {
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
         'what': what_pack.CACHED,
-        'extended': extended,
-        'valstatus': valstatus
+        'extended': opts['extended'],
+        'valstatus': res.valstatus,
+        'format': opts['format']
+      }
+    },
+
+    {
+      'aliases': [ 'sync-packages', 'update-packages' ],
+      'func': sync_packages,
+      'needs': [ 'cfg', 'valstatus', 'mirrors', 'listcache' ],
+      'locks': [ ('queue', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
+        'dryrun': opts['dryrun'],
+        'listcache': res.listcache,
+        'mirrors': res.mirrors
+      }
+    },
+
+    {
+      'aliases': [ 'watch-packages', 'watch' ],
+      'func': watch_packages,
+      'needs': [ 'cfg', 'valstatus', 'mirrors', 'listcache' ],
+      'locks': [ ('queue', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
+        'watch': res.cfg['watch'],
+        'dryrun': opts['dryrun'],
+        'listcache': res.listcache,
+        'mirrors': res.mirrors
       }
     },
 
@@ -597,19 +1863,38 @@ def main(argv):
     {
       'aliases': [ 'list', 'list-validations', 'show-validations' ],
       'func': list_validations,
-      'params': {
-        'valstatus': valstatus,
+      'needs': [ 'cfg', 'valstatus' ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
         'what': what_val.ALL,
-        'extended': extended
+        'extended': opts['extended'],
+        'filters': opts['filters'],
+        'limit': opts['limit'],
+        'format': opts['format']
       }
     },
     {
       'aliases': [ 'list-queued-validations', 'show-queued-validations' ],
       'func': list_validations,
-      'params': {
-        'valstatus': valstatus,
+      'needs': [ 'cfg', 'valstatus' ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
         'what': what_val.QUEUED,
-        'extended': extended
+        'extended': opts['extended'],
+        'filters': opts['filters'],
+        'limit': opts['limit'],
+        'format': opts['format']
+      }
+    },
+
+    {
+      'aliases': [ 'stats', 'show-stats' ],
+      'func': show_stats,
+      'needs': [ 'cfg', 'valstatus' ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'filters': opts['filters'],
+        'format': opts['format']
       }
     },
 
@@ -617,42 +1902,148 @@ def main(argv):
     {
       'aliases': [ 'queue-validation', 'add-validation' ],
       'func': queue_validation,
-      'params': {
-        'valstatus': valstatus,
-        'baseurl': cfg['alirelval']['packbaseurl'],
-        'tarball': tarball,
-        'dryrun': dryrun
+      'needs': [ 'cfg', 'valstatus', 'mirrors', 'listcache' ],
+      'locks': [ ('queue', False) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
+        'tarballs': opts['tarballs'],
+        'dryrun': opts['dryrun'],
+        'extended': opts['extended'],
+        'listcache': res.listcache,
+        'format': opts['format'],
+        'mirrors': res.mirrors
       }
     },
     {
       'aliases': [ 'start-next-queued-validation', 'run-next' ],
       'func': start_next_queued_validation,
-      'params': {
-        'valstatus': valstatus,
-        'baseurl': cfg['alirelval']['packbaseurl'],
-        'unpackdir': cfg['alirelval']['unpackdir'],
-        'modulefile': cfg['alirelval']['modulefile'],
-        'unpackcmd': cfg['alirelval']['unpackcmd'],
-        'relvalcmd': cfg['alirelval']['relvalcmd'],
-        'mail': cfg['mail'],
-        'dryrun': dryrun
+      'needs': [ 'cfg', 'valstatus', 'fetcher' ],
+      'locks': [ ('scheduler', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
+        'unpackdir': res.cfg['alirelval']['unpackdir'],
+        'modulefile': res.cfg['alirelval']['modulefile'],
+        'unpackcmd': res.cfg['alirelval']['unpackcmd'],
+        'relvalcmd': res.cfg['alirelval']['relvalcmd'],
+        'dryrun': opts['dryrun'],
+        'fetcher': res.fetcher,
+        'quota': res.cfg['alirelval']['unpackquota'],
+        'lockdir': res.cfg['alirelval']['lockdir']
+      }
+    },
+    {
+      'aliases': [ 'start-queued-validations', 'run-queued' ],
+      'func': start_queued_validations,
+      'needs': [ 'cfg', 'valstatus', 'fetcher' ],
+      'locks': [ ('scheduler', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'baseurl': res.cfg['alirelval']['packbaseurl'],
+        'unpackdir': res.cfg['alirelval']['unpackdir'],
+        'modulefile': res.cfg['alirelval']['modulefile'],
+        'unpackcmd': res.cfg['alirelval']['unpackcmd'],
+        'relvalcmd': res.cfg['alirelval']['relvalcmd'],
+        'maxrunning': res.cfg['alirelval']['maxrunning'],
+        'archslots': res.cfg['alirelval']['archslots'],
+        'platformslots': res.cfg['alirelval']['platformslots'],
+        'prefetch': res.cfg['alirelval']['prefetch'],
+        'prefetchworkers': res.cfg['alirelval']['prefetchworkers'],
+        'prefetchminfree': res.cfg['alirelval']['prefetchminfree'],
+        'dryrun': opts['dryrun'],
+        'fetcher': res.fetcher,
+        'quota': res.cfg['alirelval']['unpackquota'],
+        'lockdir': res.cfg['alirelval']['lockdir']
+      }
+    },
+    {
+      'aliases': [ 'prefetch', 'prefetch-packages' ],
+      'func': prefetch_packages,
+      'needs': [ 'cfg', 'valstatus', 'fetcher' ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'unpackdir': res.cfg['alirelval']['unpackdir'],
+        'modulefile': res.cfg['alirelval']['modulefile'],
+        'unpackcmd': res.cfg['alirelval']['unpackcmd'],
+        'count': res.cfg['alirelval']['prefetch'],
+        'workers': res.cfg['alirelval']['prefetchworkers'],
+        'minfree': res.cfg['alirelval']['prefetchminfree'],
+        'dryrun': opts['dryrun'],
+        'fetcher': res.fetcher,
+        'quota': res.cfg['alirelval']['unpackquota'],
+        'lockdir': res.cfg['alirelval']['lockdir']
+      }
+    },
+    {
+      'aliases': [ 'gc', 'evict-packages' ],
+      'func': evict_packages,
+      'needs': [ 'cfg', 'valstatus' ],
+      'locks': [ ('scheduler', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'unpackdir': res.cfg['alirelval']['unpackdir'],
+        'modulefile': res.cfg['alirelval']['modulefile'],
+        'quota': res.cfg['alirelval']['unpackquota'],
+        'lockdir': res.cfg['alirelval']['lockdir'],
+        'dryrun': opts['dryrun']
       }
     },
     {
       'aliases': [ 'update', 'refresh-validations', 'update-validations' ],
       'func': refresh_validations,
-      'params': {
-        'valstatus': valstatus,
-        'statuscmd': cfg['alirelval']['statuscmd'],
+      'needs': [ 'cfg', 'valstatus' ],
+      'locks': [ ('update', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'statuscmd': res.cfg['alirelval']['statuscmd'],
         'statusmap': Enum({
-          'RUNNING': cfg['alirelval']['statuscode_running'],
-          'NOT_RUNNING': cfg['alirelval']['statuscode_notrunning'],
-          'DONE_OK': cfg['alirelval']['statuscode_doneok'],
-          'DONE_FAIL': cfg['alirelval']['statuscode_donefail']
+          'RUNNING': res.cfg['alirelval']['statuscode_running'],
+          'NOT_RUNNING': res.cfg['alirelval']['statuscode_notrunning'],
+          'DONE_OK': res.cfg['alirelval']['statuscode_doneok'],
+          'DONE_FAIL': res.cfg['alirelval']['statuscode_donefail']
         }),
-        'resultsurl': cfg['alirelval']['resultsurl'],
-        'mail': cfg['mail'],
-        'dryrun': dryrun
+        'resultsurl': res.cfg['alirelval']['resultsurl'],
+        'dryrun': opts['dryrun'],
+        'workers': res.cfg['alirelval']['statusworkers'],
+        'timeout': res.cfg['alirelval']['statustimeout'],
+        'batchstatuscmd': res.cfg['alirelval']['batchstatuscmd']
+      }
+    },
+
+    # notifications
+    {
+      'aliases': [ 'flush-mail', 'send-mail' ],
+      'func': flush_outbox,
+      'needs': [ 'cfg', 'valstatus' ],
+      'locks': [ ('mail', True) ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'mail': res.cfg['mail'],
+        'dryrun': opts['dryrun']
+      }
+    },
+
+    # monitoring
+    {
+      'aliases': [ 'write-metrics', 'export-metrics' ],
+      'func': write_metrics,
+      'needs': [ 'cfg', 'valstatus' ],
+      'params': lambda res: {
+        'valstatus': res.valstatus,
+        'metricsfile': res.cfg['alirelval']['metricsfile'],
+        'maxattempts': res.cfg['mail']['maxattempts'],
+        'dryrun': opts['dryrun']
+      }
+    },
+
+    # daemon
+    {
+      'aliases': [ 'daemon', 'run-daemon' ],
+      'func': run_daemon,
+      'needs': [ 'cfg' ],
+      'params': {
+        'opts': opts
       }
     },
 
@@ -672,29 +2063,139 @@ def main(argv):
 
   ]
   actions[-1]['params'] = { 'actions': actions }
+  return actions
 
-  # find action
-  found = []
-  exact_match = False
-  l = len(action)
-  for a in actions:
-    for ali in a['aliases']:
-      if ali == action:
-        found = [ ali ]
-        found_action = a
-        exact_match = True
-        break
-      elif ali[:l] == action:
-        found.insert( bisect.bisect_left(found, ali), ali )
-        found_action = a
-    if exact_match:
-      break
 
+def main(argv):
+
+  init_logger(log_directory=None, debug=False)
+  log = get_logger()
+  sys.excepthook = unhandled_exception
+
+  debug = False
+  tarballs = []
+  extended = False
+  dryrun = False
+  nocache = False
+  refresh = False
+  limit = None
+  filters = {}
+  format = 'table'
+  show_timings = False
+  add_timing('imports', _import_start)
+  start = time.time()
+
+  try:
+    opts, remainder = gnu_getopt(argv, '', [ 'debug', 'tarball=', 'extended', 'dryrun', 'dry-run', 'no-cache', 'refresh',
+      'limit=', 'since=', 'until=', 'time-field=', 'arch=', 'platform=', 'version-glob=', 'status=', 'after=', 'format=', 'timings' ])
+    for o, a in opts:
+      if o == '--debug':
+        debug = True
+      elif o == '--tarball':
+        tarballs.append(a)
+      elif o == '--extended':
+        extended = True
+      elif o == '--dryrun' or o == '--dry-run':
+        dryrun = True
+      elif o == '--no-cache':
+        nocache = True
+      elif o == '--refresh':
+        refresh = True
+      elif o == '--limit':
+        limit = int(a)
+        if limit <= 0:
+          raise ValueError('limit must be positive')
+      elif o == '--since':
+        filters['since'] = parse_time(a)
+      elif o == '--until':
+        filters['until'] = parse_time(a)
+      elif o == '--time-field':
+        if a not in [ 'inserted', 'started' ]:
+          raise ValueError('time field must be inserted or started')
+        filters['timefield'] = a
+      elif o == '--arch':
+        filters['arch'] = a
+      elif o == '--platform':
+        filters['platform'] = a
+      elif o == '--version-glob':
+        filters['version_glob'] = a
+      elif o == '--status':
+        try:
+          filters.setdefault('statuses', []).append( ValStatus.status.getv(a.upper()) )
+        except AttributeError:
+          raise ValueError('invalid status: %s' % a)
+      elif o == '--after':
+        filters['after'] = parse_page_cursor(a)
+      elif o == '--format':
+        from recordwriter import RecordWriter
+        if a != 'table' and a not in RecordWriter.formats:
+          raise ValueError('format must be one of: table, %s' % ', '.join(RecordWriter.formats))
+        format = a
+      elif o == '--timings':
+        show_timings = True
+  except (GetoptError, ValueError) as e:
+    log.error('error parsing options: %s' % e)
+    return 1
+
+  try:
+    action = remainder[0]
+  except IndexError:
+    log.error('please specify an operation, or "help" for a list')
+    return 1
+
+  if debug:
+    init_logger(log_directory=None, debug=True)
+  config_file = os.path.expanduser('~/.alirelval/alirelval.conf')
+  log.debug('alirelval version %s started' % __version__)
+
+  opts = {
+    'config_file': config_file,
+    'debug': debug,
+    'tarballs': tarballs,
+    'extended': extended,
+    'dryrun': dryrun,
+    'nocache': nocache,
+    'refresh': refresh,
+    'limit': limit,
+    'filters': filters,
+    'format': format
+  }
+  actions = get_actions(opts)
+  res = Resources(opts)
+  add_timing('options', start)
+
+  found_action, found = find_action(actions, action)
   if len(found) == 1:
-    if 'params' in found_action and found_action['params'] is not None:
-      s = found_action['func']( **found_action['params'] )
+    needs = found_action.get('needs', [])
+    if 'cfg' in needs:
+      start = time.time()
+      init_logger( log_directory=res.cfg['alirelval']['logdir'], debug=debug )
+      add_timing('logger', start)
+    for n in needs:
+      getattr(res, n)
+    locks = found_action.get('locks', [])
+    if locks:
+      start = time.time()
+      held = acquire_locks(res.cfg['alirelval']['lockdir'], locks, timeout=res.cfg['alirelval']['locktimeout'])
+      add_timing('locks', start)
+      if held is None:
+        return 1
     else:
-      s = found_action['func']()
+      held = []
+    start = time.time()
+    try:
+      s = run_action(found_action, res)
+    except IOError as e:
+      # output piped into a command which exited early (e.g. head) is not an
+      # error, unlike any other I/O error (network, disk...)
+      if e.errno != errno.EPIPE or e.filename != sys.stdout.name:
+        raise
+      log.debug('output pipe closed')
+      s = True
+    finally:
+      release_locks(held)
+      add_timing('run', start)
+    close_stdout()
   elif len(found) > 1:
     log.error('ambiguous operation: matches: %s' % ', '.join(found) )
     s = False
@@ -702,12 +2203,8 @@ def main(argv):
     log.error('unknown operation: use "help" for a list of valid ones')
     s = False
 
-  try:
-    log.debug('removing pidfile %s' % cfg['alirelval']['pidfile'])
-    os.remove(cfg['alirelval']['pidfile'])
-  except OSError:
-    pass
-
+  if show_timings:
+    print_timings()
   if s:
     return 0
 
@@ -1,4 +1,6 @@
-class AliPack:
+from timestamp import TimeStamp
+
+class AliPack(object):
 
   '''An ALICE package. Fields:
       - tarball  : package file name (e.g. aliroot-blahblah.tar.gz) - not None
@@ -9,8 +11,15 @@ class AliPack:
       - org      : virtual organization (e.g. VO_ALICE) - not None
       - fetched  : was downloaded successfully - boolean, not None
       - deps     : array of package deps - may be None (but not empty)
+      - disk_size: bytes used once unpacked - may be None
+      - last_used: when it was last unpacked or used (TimeStamp) - may be None
+
+     Deps are split only when first accessed.
   '''
 
+  __slots__ = ('id', 'tarball', 'software', 'version', 'platform', 'arch', 'org',
+    'fetched', 'disk_size', 'last_used', '_deps', '_rawdeps', '_baseurl')
+
   def __init__(self, rawstring=None, dictionary=None, baseurl=None):
     if baseurl is None:
       raise AliPackError('baseurl missing')
@@ -40,6 +49,14 @@ class AliPack:
       id = '<no id>'
     else:
       id = str(self.id)
+    if self.disk_size is None:
+      disk_size = '<unknown>'
+    else:
+      disk_size = '%.1f MB' % (self.disk_size / 1048576.)
+    if self.last_used is None:
+      last_used = '<never>'
+    else:
+      last_used = str(self.last_used)
     return \
       'Package %s:\n' \
       ' - Id       : %s\n' \
@@ -50,19 +67,53 @@ class AliPack:
       ' - Arch     : %s\n' \
       ' - Org      : %s\n' \
       ' - Fetched  : %s\n' \
+      ' - Size     : %s\n' \
+      ' - Used     : %s\n' \
       ' - Deps     : %s' \
       % (self.get_package_name(), id, self.get_url(), self.software, \
-         self.version, platform, arch, self.org, fetched, deps)
+         self.version, platform, arch, self.org, fetched, disk_size, \
+         last_used, deps)
+
+  @property
+  def deps(self):
+    if self._rawdeps is not None:
+      self._deps = self._rawdeps.split(',')
+      self._rawdeps = None
+    return self._deps
+
+  @deps.setter
+  def deps(self, deps):
+    self._deps = deps
+    self._rawdeps = None
+
+  def get_deps_str(self):
+    '''Returns the comma-separated deps, as stored in the database, or None.'''
+    if self._rawdeps is not None:
+      return self._rawdeps
+    if self._deps is None:
+      return None
+    return ','.join(self._deps)
 
   def get_package_name(self):
     return '%s@%s::%s' % (self.org, self.software, self.version)
 
+  @staticmethod
+  def parse_package_name(name):
+    '''Splits a package name (e.g. VO_ALICE@ROOT::v5-34-08, as found in deps)
+       into an (org, software, version) tuple. Returns None if invalid.
+    '''
+    org, sep, rest = name.partition('@')
+    software, sep2, version = rest.partition('::')
+    if not (org and sep and software and sep2 and version):
+      return None
+    return (org, software, version)
+
   def get_url(self):
     return '%s/%s' % ( self._baseurl, self.tarball )
 
   def _from_dict(self, dictionary, baseurl):
-    '''Constructs the package definition from a dictionary. May throw a
-       KeyError.
+    '''Constructs the package definition from a dictionary or from a database
+       row. May throw a KeyError or an IndexError.
     '''
     self.id       = dictionary['package_id']
     self.tarball  = dictionary['tarball']
@@ -72,11 +123,15 @@ class AliPack:
     self.arch     = dictionary['arch']
     self.fetched  = (dictionary['fetched'] != 0)
     self.org      = dictionary['org']
+    self.disk_size = dictionary['disk_size']
 
-    if dictionary['deps'] is not None:
-      self.deps = dictionary['deps'].split(',')
+    if dictionary['last_used'] is not None:
+      self.last_used = TimeStamp( dictionary['last_used'] )
     else:
-      self.deps = None
+      self.last_used = None
+
+    self._deps = None
+    self._rawdeps = dictionary['deps']
 
     self._baseurl = baseurl
 
@@ -122,11 +177,14 @@ class AliPack:
       self._baseurl = baseurl
       self.fetched = False
       self.id = None
+      self.disk_size = None
+      self.last_used = None
 
+      self._deps = None
       if len(a) > 5:
-        self.deps = a[5].split(',')
+        self._rawdeps = a[5]
       else:
-        self.deps = None
+        self._rawdeps = None
 
     except IndexError:
       raise AliPackError('invalid string format for package definition: %s' % rawstring)
@@ -41,6 +41,11 @@ class Enum:
   def getv(self, key):
     return getattr(self, key)
 
+  def getkv(self):
+    '''Returns all the (key, value) pairs, sorted by value.
+    '''
+    return [ (k, v) for v, k in sorted(self._invdict.items()) ]
+
   def _isnamevalid(self, name):
     if re.search(r'^[a-zA-Z][a-zA-Z0-9_]*$', name):
       return True
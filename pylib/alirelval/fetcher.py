@@ -0,0 +1,266 @@
+import os
+import shutil
+import hashlib
+import logging
+from mirrors import urlopen
+
+# tarfile and tempfile are slow to import: they are imported by the methods
+# using them, so that creating a PackFetcher is cheap
+
+
+class PackFetcher:
+
+  '''Downloads a package tarball and unpacks it on the fly: the HTTP body is
+     fed straight into tarfile in stream mode, the first path component of
+     each member is stripped (like tar --strip-components=1) and the result is
+     atomically renamed into the destination directory.
+
+     If a staging directory is given, the received bytes are also appended to
+     a staging file there, so that an interrupted transfer can be resumed with
+     an HTTP Range request instead of starting from zero. Size is verified
+     against the Content-Length, and the checksum against a .sha256 or .md5
+     sidecar file if the server provides one. Tarballs and sidecars are
+     downloaded through the given MirrorPool, if any.
+  '''
+
+  sidecars = [ ('sha256', '.sha256'), ('md5', '.md5') ]
+
+  def __init__(self, stagingdir=None, mirrors=None):
+    self._stagingdir = stagingdir
+    self._mirrors = mirrors
+    self._log = logging.getLogger('PackFetcher')
+    if stagingdir is not None and not os.path.isdir(stagingdir):
+      os.makedirs(stagingdir, 0755)
+
+  def fetch(self, url, destdir):
+    '''Downloads the tarball at url and unpacks it into destdir, replacing it
+       if it exists. May throw IOError, if the transfer failed (the staged
+       bytes are kept to resume it), or PackFetcherError, if the tarball is
+       corrupted.
+    '''
+    checksum = self._get_checksum(url)
+    if self._stagingdir is not None:
+      stagingfile = '%s/%s' % (self._stagingdir, os.path.basename(url))
+    else:
+      stagingfile = None
+
+    resp, offset, total = self._open(url, stagingfile)
+    if stagingfile is not None:
+      if offset > 0:
+        self._log.info('resuming download of %s from byte %d' % (url, offset))
+        staged = open(stagingfile, 'rb')
+        staging = open(stagingfile, 'ab')
+      else:
+        staged = None
+        staging = open(stagingfile, 'wb')
+      etag = resp.info().getheader('ETag')
+      if etag is not None:
+        with open(stagingfile+'.etag', 'w') as f:
+          f.write(etag)
+    else:
+      staged = None
+      staging = None
+
+    if checksum is not None:
+      hasher = hashlib.new(checksum[0])
+    else:
+      hasher = None
+    reader = _TeeReader(staged, resp, staging, hasher)
+
+    import tempfile, tarfile, zlib, httplib
+    parent = os.path.dirname( os.path.normpath(destdir) )
+    if not os.path.isdir(parent):
+      os.makedirs(parent)
+    tmpdir = tempfile.mkdtemp(prefix='.%s.' % os.path.basename(os.path.normpath(destdir)), dir=parent)
+    complete = False
+    try:
+      try:
+        self._extract(reader, tmpdir)
+        error = None
+      except (tarfile.TarError, zlib.error) as e:
+        error = e
+      # what is left is read in any case: a tarball failing to unpack because
+      # the transfer was cut short is told apart from a corrupted one
+      reader.drain()
+      if total is not None and reader.count < total:
+        raise IOError('transfer of %s interrupted after %d of %d bytes' % (url, reader.count, total))
+      if total is not None and reader.count != total:
+        raise PackFetcherError('size mismatch for %s: expected %d bytes, got %d' % (url, total, reader.count))
+      if error is not None:
+        raise PackFetcherError('cannot unpack %s: %s' % (url, error))
+      if checksum is not None and hasher.hexdigest() != checksum[1]:
+        raise PackFetcherError('%s checksum mismatch for %s' % (checksum[0], url))
+      if os.path.isdir(destdir):
+        shutil.rmtree(destdir)
+      os.rename(tmpdir, destdir)
+      complete = True
+    except httplib.HTTPException as e:
+      raise IOError('transfer of %s interrupted after %d bytes: %s' % (url, reader.count, e))
+    except PackFetcherError:
+      # staged data is corrupted: do not resume from it
+      self._remove_staging(stagingfile)
+      raise
+    finally:
+      resp.close()
+      if staged is not None:
+        staged.close()
+      if staging is not None:
+        staging.close()
+      if not complete:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    self._remove_staging(stagingfile)
+    self._log.debug('%s unpacked in %s (%d bytes)' % (url, destdir, reader.count))
+
+  def _open(self, url, stagingfile):
+    '''Opens url, resuming from the staging file if possible. Returns the
+       response, the offset it starts from and the expected total size (None
+       if unknown).
+    '''
+    offset = 0
+    if stagingfile is not None and os.path.isfile(stagingfile):
+      offset = os.path.getsize(stagingfile)
+    headers = {}
+    if offset > 0:
+      headers['Range'] = 'bytes=%d-' % offset
+      try:
+        with open(stagingfile+'.etag', 'r') as f:
+          headers['If-Range'] = f.read().strip()
+      except IOError:
+        pass
+    resp = urlopen(url, headers, mirrors=self._mirrors)
+    if resp.getcode() == 416 and offset > 0:
+      resp.close()
+      self._log.debug('cannot resume %s: downloading it from scratch' % url)
+      self._remove_staging(stagingfile)
+      return self._open(url, stagingfile)
+
+    total = None
+    if resp.getcode() == 206:
+      crange = resp.info().getheader('Content-Range')
+      if crange is not None and not crange.endswith('/*'):
+        total = int(crange.rsplit('/', 1)[1])
+    elif resp.getcode() == 200:
+      if offset > 0:
+        self._log.debug('server does not support resuming %s: downloading it from scratch' % url)
+      offset = 0
+      clen = resp.info().getheader('Content-Length')
+      if clen is not None:
+        total = int(clen)
+    else:
+      resp.close()
+      raise IOError('code %d while reading %s' % (resp.getcode(), url))
+    return (resp, offset, total)
+
+  def _extract(self, fileobj, destdir):
+    import tarfile
+    topmode = 0755
+    topdir = os.path.realpath(destdir)
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+      for m in tar:
+        name = self._strip(m.name)
+        if name is None:
+          if m.isdir() and '/' not in m.name.rstrip('/'):
+            topmode = m.mode
+          continue
+        m.name = name
+        dest = os.path.join(destdir, name)
+        if m.islnk():
+          linkname = self._strip(m.linkname)
+          if linkname is None:
+            continue
+          m.linkname = linkname
+          target = os.path.join(destdir, linkname)
+        elif m.issym():
+          target = os.path.join(os.path.dirname(dest), m.linkname)
+        else:
+          target = dest
+        # members are not written through links, nor are links created, that
+        # point out of destdir
+        if not self._is_inside(dest, topdir) or not self._is_inside(target, topdir):
+          self._log.warning('skipping tarball member pointing outside of its directory: %s' % name)
+          continue
+        tar.extract(m, destdir)
+    # the top directory takes the place of destdir
+    os.chmod(destdir, topmode)
+
+  def _is_inside(self, path, topdir):
+    path = os.path.realpath(path)
+    return path == topdir or path.startswith(topdir+'/')
+
+  def _strip(self, name):
+    '''Strips the first path component. Returns None for members to skip: the
+       top directory itself and members with unsafe paths.
+    '''
+    a = name.split('/', 1)
+    if len(a) < 2 or a[1] == '':
+      return None
+    name = a[1]
+    if name.startswith('/') or '..' in name.split('/'):
+      self._log.warning('skipping tarball member with unsafe path: %s' % name)
+      return None
+    return name
+
+  def _get_checksum(self, url):
+    '''Returns a tuple with the hash algorithm and the expected hex digest read
+       from the first available sidecar, or None.
+    '''
+    for algo, ext in self.sidecars:
+      resp = urlopen(url+ext, mirrors=self._mirrors)
+      try:
+        if resp.getcode() != 200:
+          continue
+        a = resp.read().split()
+      finally:
+        resp.close()
+      if len(a) > 0:
+        self._log.debug('expected %s for %s: %s' % (algo, url, a[0]))
+        return (algo, a[0].lower())
+    return None
+
+  def _remove_staging(self, stagingfile):
+    if stagingfile is None:
+      return
+    for f in [ stagingfile, stagingfile+'.etag' ]:
+      try:
+        os.remove(f)
+      except OSError:
+        pass
+
+
+class _TeeReader:
+
+  '''File-like object reading first from an already staged file, then from a
+     network stream. Bytes read from the network are appended to the staging
+     file; all bytes are counted and hashed.
+  '''
+
+  def __init__(self, staged, stream, staging, hasher):
+    self._staged = staged
+    self._stream = stream
+    self._staging = staging
+    self._hasher = hasher
+    self.count = 0
+
+  def read(self, size=-1):
+    buf = ''
+    if self._staged is not None:
+      buf = self._staged.read(size)
+      if len(buf) == 0:
+        self._staged = None
+    if len(buf) == 0:
+      buf = self._stream.read(size)
+      if self._staging is not None:
+        self._staging.write(buf)
+    self.count += len(buf)
+    if self._hasher is not None:
+      self._hasher.update(buf)
+    return buf
+
+  def drain(self):
+    while len(self.read(1048576)) > 0:
+      pass
+
+
+class PackFetcherError(Exception):
+  pass
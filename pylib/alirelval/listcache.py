@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from mirrors import urlopen
+
+
+class ListCache:
+
+  '''Persistent on-disk cache of the remote package listings. For each URL the
+     body is stored together with its ETag and Last-Modified headers: when the
+     cached copy is older than the TTL it is revalidated with a conditional GET
+     and reused as-is if the server answers 304. The SHA1 of the body is kept
+     as well, to tell whether a listing changed without reading it. Listings
+     are downloaded through the given MirrorPool, if any.
+  '''
+
+  def __init__(self, cachedir=None, ttl=0, mirrors=None):
+    if cachedir is None:
+      raise ListCacheError('cachedir is mandatory')
+    self._cachedir = cachedir
+    self._ttl = ttl
+    self._mirrors = mirrors
+    self._log = logging.getLogger('ListCache')
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir, 0755)
+
+  def iter_lines(self, url, revalidate=True):
+    '''Generator yielding the lines of the listing found at url, either from
+       the cache or straight off the HTTP response. A fresh download is
+       written to the cache while being read, and committed only if it was
+       read until the end. If revalidate is False, a cached copy is used
+       regardless of its age. May throw an IOError.
+    '''
+    return self._iter_lines(url, revalidate=revalidate, read=True)
+
+  def get_digest(self, url):
+    '''Brings the cached copy of the listing found at url up to date, like
+       iter_lines() does, and returns the SHA1 of its body. The cached body
+       is not read unless it was just downloaded. May throw an IOError.
+    '''
+    for l in self._iter_lines(url, revalidate=True, read=False):
+      pass
+    bodyfile, metafile = self._get_paths(url)
+    meta = self._read_meta(metafile)
+    if meta.get('sha1') is None:
+      # cached before digests were kept
+      sha1 = hashlib.sha1()
+      for l in self._iter_file(bodyfile):
+        sha1.update(l)
+      meta['sha1'] = sha1.hexdigest()
+      self._write_meta(metafile, meta)
+    return meta['sha1']
+
+  def _iter_lines(self, url, revalidate, read):
+    bodyfile, metafile = self._get_paths(url)
+    meta = self._read_meta(metafile)
+    if meta is not None and not os.path.isfile(bodyfile):
+      meta = None
+
+    if meta is not None and (not revalidate or time.time()-meta['checked'] < self._ttl):
+      self._log.debug('cached listing for %s is fresh: not revalidating' % url)
+      if read:
+        for l in self._iter_file(bodyfile):
+          yield l
+      return
+
+    headers = {}
+    if meta is not None:
+      if meta['etag'] is not None:
+        headers['If-None-Match'] = meta['etag']
+      if meta['last_modified'] is not None:
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    resp = urlopen(url, headers, mirrors=self._mirrors)
+    if resp.getcode() == 304 and meta is not None:
+      resp.close()
+      self._log.debug('listing for %s not modified: reusing cached copy' % url)
+      meta['checked'] = time.time()
+      self._write_meta(metafile, meta)
+      if read:
+        for l in self._iter_file(bodyfile):
+          yield l
+      return
+
+    if resp.getcode() != 200:
+      resp.close()
+      raise IOError('code %d while reading %s' % (resp.getcode(), url))
+
+    self._log.debug('downloading listing %s into the cache' % url)
+    tmpfile = '%s.%d.tmp' % (bodyfile, os.getpid())
+    sha1 = hashlib.sha1()
+    complete = False
+    try:
+      with open(tmpfile, 'w') as f:
+        for l in resp:
+          f.write(l)
+          sha1.update(l)
+          yield l
+      os.rename(tmpfile, bodyfile)
+      complete = True
+    finally:
+      resp.close()
+      if not complete:
+        self._log.debug('listing %s not read until the end: not caching it' % url)
+        if os.path.isfile(tmpfile):
+          os.remove(tmpfile)
+
+    self._write_meta(metafile, {
+      'url': url,
+      'etag': resp.info().getheader('ETag'),
+      'last_modified': resp.info().getheader('Last-Modified'),
+      'sha1': sha1.hexdigest(),
+      'checked': time.time()
+    })
+
+  def _iter_file(self, filename):
+    with open(filename, 'r') as f:
+      for l in f:
+        yield l
+
+  def _get_paths(self, url):
+    key = hashlib.sha1(url).hexdigest()
+    return ( '%s/%s.body' % (self._cachedir, key), '%s/%s.meta' % (self._cachedir, key) )
+
+  def _read_meta(self, metafile):
+    try:
+      with open(metafile, 'r') as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def _write_meta(self, metafile, meta):
+    tmpfile = '%s.%d.tmp' % (metafile, os.getpid())
+    with open(tmpfile, 'w') as f:
+      json.dump(meta, f)
+    os.rename(tmpfile, metafile)
+
+
+class ListCacheError(Exception):
+  pass
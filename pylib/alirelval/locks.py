@@ -0,0 +1,67 @@
+import os
+import time
+import errno
+import fcntl
+import logging
+
+
+class NamedLock:
+
+  '''Advisory lock taken with flock() on a file named after the lock, in the
+     given directory. It can be held in shared or exclusive mode, and it is
+     released by the kernel when the process exits, so it never goes stale.
+  '''
+
+  def __init__(self, lockdir=None, name=None):
+    if lockdir is None or name is None:
+      raise NamedLockError('lockdir and name are mandatory')
+    self.name = name
+    self._lockdir = lockdir
+    self._path = '%s/%s.lock' % (lockdir, name.replace('/', '_'))
+    self._fd = None
+    self._log = logging.getLogger('NamedLock')
+
+  def acquire(self, exclusive=True, timeout=None):
+    '''Takes the lock, waiting at most timeout seconds for it (forever if None,
+       not at all if 0). Returns True on success, False on timeout.
+    '''
+    if self._fd is not None:
+      raise NamedLockError('lock %s already held' % self.name)
+    if not os.path.isdir(self._lockdir):
+      os.makedirs(self._lockdir, 0755)
+    if exclusive:
+      op = fcntl.LOCK_EX
+      mode = 'exclusive'
+    else:
+      op = fcntl.LOCK_SH
+      mode = 'shared'
+    fd = os.open(self._path, os.O_RDWR|os.O_CREAT, 0644)
+    if timeout is not None:
+      deadline = time.time() + timeout
+    while True:
+      try:
+        fcntl.flock(fd, op|fcntl.LOCK_NB)
+        self._fd = fd
+        self._log.debug('lock %s taken (%s)' % (self.name, mode))
+        return True
+      except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          os.close(fd)
+          raise
+      if timeout is not None and time.time() >= deadline:
+        os.close(fd)
+        self._log.debug('timeout waiting for lock %s (%s)' % (self.name, mode))
+        return False
+      time.sleep(0.1)
+
+  def release(self):
+    if self._fd is None:
+      return
+    fcntl.flock(self._fd, fcntl.LOCK_UN)
+    os.close(self._fd)
+    self._fd = None
+    self._log.debug('lock %s released' % self.name)
+
+
+class NamedLockError(Exception):
+  pass
@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import logging
+
+# httplib, socket, threading and urllib2 are imported by the methods using
+# them, so that creating a MirrorPool is cheap
+
+
+def urlopen(url, headers={}, mirrors=None):
+  '''GETs url with the given extra headers, through the given MirrorPool if
+     any, or with urllib2 otherwise. The response is returned whatever its
+     status (check it with getcode()): an IOError is raised only if no
+     response could be obtained.
+  '''
+  if mirrors is not None:
+    return mirrors.urlopen(url, headers)
+  import urllib2
+  req = urllib2.Request(url)
+  for k, v in headers.items():
+    req.add_header(k, v)
+  try:
+    return urllib2.urlopen(req)
+  except urllib2.HTTPError as e:
+    return e
+
+
+class MirrorPool:
+
+  '''Set of equivalent mirrors of the package repository, the first of which
+     names the packages: URLs under any of them are fetched from the best
+     mirror, failing over to the next ones on connection errors, server
+     errors and missing files.
+
+     Mirrors are ranked by their measured latency (time to the response
+     headers) and throughput (of transfers larger than throughput_min bytes),
+     both exponentially averaged and saved in statefile, so that they are
+     known from the first request of the next run. A failing mirror is
+     avoided for a time doubling at each consecutive failure. Mirrors never
+     measured are tried first, in the order given.
+
+     HTTP/1.1 connections are kept open after each response read until the
+     end, and reused for the next request to the same host.
+  '''
+
+  alpha = 0.3
+  throughput_min = 262144
+  ref_size = 1048576
+  max_redirects = 5
+
+  def __init__(self, baseurls=None, timeout=30, statefile=None):
+    if not baseurls:
+      raise MirrorPoolError('at least one mirror is mandatory')
+    import threading
+    self._baseurls = [ u.rstrip('/') for u in baseurls ]
+    self._timeout = timeout
+    self._statefile = statefile
+    self._stats = None
+    self._idle = {}
+    self._lock = threading.Lock()
+    self._log = logging.getLogger('MirrorPool')
+
+  def urlopen(self, url, headers={}):
+    '''GETs url, from the best mirror if it is under any of them, trying the
+       others in turn if needed. Returns a MirrorResponse whatever its status:
+       if no mirror had the file, a 404 is preferred to a server error.
+       Mirrors being avoided are not tried once a healthy one answered 404.
+       Raises an IOError if no mirror could be reached.
+    '''
+    path = self._get_path(url)
+    if path is None:
+      return self._get(url, headers)
+    last = None
+    errors = []
+    for base in self._rank():
+      if last is not None and last.getcode() == 404 and self._is_down(base):
+        break
+      start = time.time()
+      try:
+        resp = self._get(base+path, headers)
+      except IOError as e:
+        self._failed(base, str(e))
+        errors.append( '%s: %s' % (base, e) )
+        continue
+      if resp.getcode() >= 500:
+        self._failed(base, 'code %d' % resp.getcode())
+      elif resp.getcode() == 404:
+        self._log.debug('%s not found on mirror %s' % (path, base))
+      else:
+        self._succeeded(base, time.time()-start)
+        resp._on_complete = lambda size, secs, base=base: self._measured(base, size, secs)
+        if last is not None:
+          last.close()
+        return resp
+      errors.append( '%s: code %d' % (base, resp.getcode()) )
+      if last is None or (resp.getcode() == 404 and last.getcode() != 404):
+        if last is not None:
+          last.close()
+        last = resp
+      else:
+        resp.close()
+    if last is not None:
+      return last
+    raise IOError('cannot get %s from any mirror: %s' % (path, '; '.join(errors)))
+
+  def get_mirrors(self):
+    '''Returns the mirrors, best first, with their measurements.'''
+    stats = self._get_stats()
+    return [ (base, stats[base]) for base in self._rank() ]
+
+  def close(self):
+    '''Closes all the idle connections.'''
+    with self._lock:
+      for conns in self._idle.values():
+        for conn in conns:
+          conn.close()
+      self._idle = {}
+
+  def _get_path(self, url):
+    for base in self._baseurls:
+      if url.startswith(base+'/'):
+        return url[len(base):]
+    return None
+
+  def _get(self, url, headers, redirects=None):
+    '''GETs url on a pooled connection. A stale pooled connection (closed by
+       the server while idle) is replaced by a new one transparently.
+    '''
+    import httplib, socket, urlparse
+    if redirects is None:
+      redirects = self.max_redirects
+    u = urlparse.urlsplit(url)
+    if u.scheme not in [ 'http', 'https' ]:
+      raise IOError('unsupported URL: %s' % url)
+    key = (u.scheme, u.hostname, u.port)
+    path = u.path or '/'
+    if u.query:
+      path += '?' + u.query
+    reqheaders = { 'Connection': 'keep-alive' }
+    reqheaders.update(headers)
+    while True:
+      conn, reused = self._take(key)
+      try:
+        conn.request('GET', path, headers=reqheaders)
+        resp = conn.getresponse()
+        break
+      except (httplib.HTTPException, socket.error) as e:
+        conn.close()
+        if not reused:
+          raise IOError('error while reading %s: %s' % (url, e))
+        self._log.debug('pooled connection to %s closed by the server: reconnecting' % u.hostname)
+
+    location = resp.getheader('Location')
+    if resp.status in [ 301, 302, 303, 307, 308 ] and location is not None:
+      MirrorResponse(self, key, conn, resp, url).close()
+      if redirects <= 0:
+        raise IOError('too many redirects while reading %s' % url)
+      return self._get(urlparse.urljoin(url, location), headers, redirects-1)
+    return MirrorResponse(self, key, conn, resp, url)
+
+  def _take(self, key):
+    with self._lock:
+      conns = self._idle.get(key)
+      if conns:
+        return (conns.pop(), True)
+    import httplib
+    scheme, host, port = key
+    if scheme == 'https':
+      return (httplib.HTTPSConnection(host, port, timeout=self._timeout), False)
+    return (httplib.HTTPConnection(host, port, timeout=self._timeout), False)
+
+  def _give(self, key, conn):
+    with self._lock:
+      self._idle.setdefault(key, []).append(conn)
+
+  def _is_down(self, base):
+    return self._get_stats()[base]['down_until'] > time.time()
+
+  def _rank(self):
+    stats = self._get_stats()
+    now = time.time()
+    def score(base):
+      st = stats[base]
+      s = st['latency'] or 0
+      if st['throughput']:
+        s += float(self.ref_size) / st['throughput']
+      return s
+    healthy = [ b for b in self._baseurls if stats[b]['down_until'] <= now ]
+    down = [ b for b in self._baseurls if stats[b]['down_until'] > now ]
+    # mirrors being avoided are still tried as a last resort
+    return sorted(healthy, key=score) + sorted(down, key=lambda b: stats[b]['down_until'])
+
+  def _get_stats(self):
+    if self._stats is None:
+      stats = {}
+      if self._statefile is not None:
+        try:
+          with open(self._statefile, 'r') as f:
+            stats = json.load(f)
+        except (IOError, ValueError):
+          pass
+      self._stats = {}
+      for base in self._baseurls:
+        st = { 'latency': None, 'throughput': None, 'failures': 0, 'down_until': 0 }
+        st.update( stats.get(base, {}) )
+        self._stats[base] = st
+    return self._stats
+
+  def _average(self, old, new):
+    if old is None:
+      return new
+    return (1-self.alpha)*old + self.alpha*new
+
+  def _succeeded(self, base, latency):
+    with self._lock:
+      st = self._get_stats()[base]
+      st['latency'] = self._average(st['latency'], latency)
+      st['failures'] = 0
+      st['down_until'] = 0
+      self._save()
+
+  def _failed(self, base, error):
+    with self._lock:
+      st = self._get_stats()[base]
+      st['failures'] += 1
+      delay = min(600, 10 << min(st['failures']-1, 6))
+      st['down_until'] = time.time() + delay
+      self._save()
+    self._log.warning('mirror %s failed (%s): avoiding it for %d s' % (base, error, delay))
+
+  def _measured(self, base, size, secs):
+    if size < self.throughput_min or secs <= 0:
+      return
+    with self._lock:
+      st = self._get_stats()[base]
+      st['throughput'] = self._average(st['throughput'], size/secs)
+      self._save()
+    self._log.debug('mirror %s: %.1f MB/s' % (base, size/secs/1048576.))
+
+  def _save(self):
+    if self._statefile is None:
+      return
+    tmpfile = '%s.%d.tmp' % (self._statefile, os.getpid())
+    try:
+      with open(tmpfile, 'w') as f:
+        json.dump(self._stats, f)
+      os.rename(tmpfile, self._statefile)
+    except (IOError, OSError) as e:
+      self._log.debug('cannot save mirror state to %s: %s' % (self._statefile, e))
+
+
+class MirrorResponse:
+
+  '''HTTP response with the interface of the urllib2 ones used here. When
+     closed after being read until the end, its connection goes back to the
+     pool unless the server asked to close it.
+  '''
+
+  def __init__(self, pool, key, conn, resp, url):
+    self._pool = pool
+    self._key = key
+    self._conn = conn
+    self._resp = resp
+    self._url = url
+    self._start = time.time()
+    self._size = 0
+    self._closed = False
+    self._on_complete = None
+
+  def getcode(self):
+    return self._resp.status
+
+  def info(self):
+    return self._resp.msg
+
+  def geturl(self):
+    return self._url
+
+  def read(self, size=-1):
+    if self._closed:
+      return ''
+    if size is None or size < 0:
+      buf = self._resp.read()
+    else:
+      buf = self._resp.read(size)
+    self._size += len(buf)
+    return buf
+
+  def __iter__(self):
+    rest = ''
+    while True:
+      buf = self.read(65536)
+      if buf == '':
+        break
+      lines = (rest+buf).split('\n')
+      rest = lines.pop()
+      for l in lines:
+        yield l + '\n'
+    if rest != '':
+      yield rest
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    resp = self._resp
+    if not resp.isclosed() and resp.length is not None and resp.length <= 65536:
+      # drain short bodies (error pages, 304) to keep the connection
+      try:
+        resp.read()
+      except Exception:
+        pass
+    if resp.isclosed() and not resp.will_close:
+      self._pool._give(self._key, self._conn)
+      if self._on_complete is not None:
+        self._on_complete(self._size, time.time()-self._start)
+    else:
+      self._conn.close()
+
+
+class MirrorPoolError(Exception):
+  pass
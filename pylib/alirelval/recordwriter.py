@@ -0,0 +1,72 @@
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+
+class RecordWriter:
+
+  '''Writes records with a fixed list of fields in a machine-readable format,
+     one at a time, as soon as they are available: memory usage does not
+     depend on the number of records. Supported formats:
+      - jsonl: one JSON object per line, fields in order, None as null
+      - csv  : comma-separated values with a header line
+      - tsv  : tab-separated values with a header line
+     Lists are written as JSON arrays, or comma-joined in csv and tsv, where
+     None is written as an empty string and booleans as true or false.
+     Write errors are raised as IOErrors naming the output file, so that a
+     closed output pipe can be told apart from other errors.
+  '''
+
+  formats = [ 'jsonl', 'csv', 'tsv' ]
+
+  def __init__(self, fmt=None, fields=None, out=None):
+    if fmt not in self.formats:
+      raise RecordWriterError('invalid format: %s' % fmt)
+    if fields is None:
+      raise RecordWriterError('fields are mandatory')
+    if out is None:
+      out = sys.stdout
+    self._fields = fields
+    self._out = out
+    if fmt == 'jsonl':
+      self._write = self._write_jsonl
+    else:
+      if fmt == 'csv':
+        self._csv = csv.writer(out, dialect='excel', lineterminator='\n')
+      else:
+        self._csv = csv.writer(out, dialect='excel-tab', lineterminator='\n')
+      self._output(self._csv.writerow, fields)
+      self._write = self._write_csv
+
+  def write(self, values):
+    self._output(self._write, values)
+
+  def _output(self, func, values):
+    try:
+      func(values)
+    except IOError as e:
+      if e.filename is None:
+        e.filename = getattr(self._out, 'name', None)
+      raise
+
+  def _write_jsonl(self, values):
+    self._out.write( json.dumps( OrderedDict(zip(self._fields, values)) ) + '\n' )
+
+  def _write_csv(self, values):
+    row = []
+    for v in values:
+      if v is None:
+        v = ''
+      elif isinstance(v, bool):
+        v = 'true' if v else 'false'
+      elif isinstance(v, list):
+        v = ','.join(v)
+      if isinstance(v, unicode):
+        v = v.encode('utf-8')
+      row.append(v)
+    self._csv.writerow(row)
+
+
+class RecordWriterError(Exception):
+  pass
@@ -1,48 +1,100 @@
-import calendar, datetime
+import time
 from enum import Enum
 
-class TimeStamp:
+# datetime is imported by the methods formatting timestamps: comparing and
+# subtracting them does not need it
+
+class TimeStamp(object):
 
   '''Python handles dates like crazy. This class is constructed from a
-     timestamp, holds a naive datetime and has methods with crystal clear
-     names. Small but sufficient for our purposes.
+     timestamp in integer microseconds since the epoch (UTC) and has methods
+     with crystal clear names. Small but sufficient for our purposes.
+     Comparing and subtracting timestamps is plain integer arithmetic: a
+     datetime is built only when formatting.
   '''
 
+  __slots__ = ('_usec',)
+
   datefmt = Enum({
     'NO_USEC': '%Y-%m-%d %H:%M:%S',
     'DATE_ONLY': '%Y-%m-%d',
-    'TIME_ONLY': '%H:%M:%S'
+    'TIME_ONLY': '%H:%M:%S',
+    'ISO8601': '%Y-%m-%dT%H:%M:%SZ'
   })
 
-  def __init__(self, ts_utc=None):
-    if ts_utc is None:
-      self._dt_utc = datetime.datetime.utcnow()
-    else:
-      self._dt_utc = datetime.datetime.utcfromtimestamp(ts_utc)
+  def __init__(self, usec_utc=None):
+    if usec_utc is None:
+      usec_utc = int(time.time()*1000000)
+    self._usec = usec_utc
+
+  @staticmethod
+  def from_seconds(ts_utc):
+    return TimeStamp( int(round(ts_utc*1000000)) )
 
   def get_timestamp_usec_utc(self):
-    return calendar.timegm( self._dt_utc.utctimetuple() ) + self._dt_utc.microsecond * 0.000001
+    return self._usec
+
+  def get_timestamp_utc(self):
+    '''Seconds since the epoch, as a float.
+    '''
+    return self._usec / 1000000.0
+
+  def get_elapsed_sec(self):
+    '''Seconds elapsed since this timestamp, as a float.
+    '''
+    return (int(time.time()*1000000)-self._usec) / 1000000.0
 
   def get_datetime_naive_utc(self):
-    return self._dt_utc
+    import datetime
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=self._usec)
 
   def get_formatted_str(self, format):
-    return self._dt_utc.strftime(format)
+    return self.get_datetime_naive_utc().strftime(format)
+
+  @staticmethod
+  def format_delta(usec):
+    '''Formats a difference between timestamps, in microseconds, as H:MM:SS
+       (days are prepended if any), truncating the fraction of second.
+    '''
+    import datetime
+    return str( datetime.timedelta(seconds=usec//1000000) )
 
   def __str__(self):
-    #return self._dt_utc.strftime('%Y-%m-%e %H:%M:%S')
-    return str(self._dt_utc)
+    return str( self.get_datetime_naive_utc() )
 
   def __sub__(self, other):
-    '''Returns a timedelta object. Order: self-other. Get seconds with
-       <timedelta>.total_seconds().
+    '''Returns the difference in integer microseconds. Order: self-other.
     '''
-    return datetime.timedelta( seconds=self.get_timestamp_usec_utc()-other.get_timestamp_usec_utc() )
+    return self._usec - other._usec
+
+  def __eq__(self, other):
+    return isinstance(other, TimeStamp) and self._usec == other._usec
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __lt__(self, other):
+    return self._usec < other._usec
+
+  def __le__(self, other):
+    return self._usec <= other._usec
+
+  def __gt__(self, other):
+    return self._usec > other._usec
+
+  def __ge__(self, other):
+    return self._usec >= other._usec
+
+  def __hash__(self):
+    return hash(self._usec)
 
   @staticmethod
   def assert_unit_test():
-    tsraw = 1406754375.6
+    tsraw = 1406754375600000
     tsstr = '2014-07-30 21:06:15.600000'
-    tsobj = TimeStamp(1406754375.6)
+    tsobj = TimeStamp(1406754375600000)
     assert tsobj.get_timestamp_usec_utc() == tsraw, 'UTC timestamps does not correspond'
     assert str(tsobj) == tsstr, 'UTC string representations do not correspond'
+    assert TimeStamp.from_seconds(1406754375.6) == tsobj, 'conversion from seconds is not exact'
+    assert tsobj - TimeStamp(tsraw-1500000) == 1500000, 'difference is not in microseconds'
+    assert TimeStamp.format_delta(90061500000) == '1 day, 1:01:01', 'delta is not formatted correctly'
@@ -1,15 +1,10 @@
-import sqlite3
 import logging
 from alipack import AliPack, AliPackError
 from timestamp import TimeStamp
 from enum import Enum
 
-
-def sqlite3_dict_factory(cursor, row):
-  d = {}
-  for idx, col in enumerate(cursor.description):
-      d[col[0]] = row[idx]
-  return d
+# sqlite3 is slow to import (it pulls in threading and datetime): it is imported
+# when the database is opened, so that commands not using it do not pay for it
 
 
 class ValStatus:
@@ -19,19 +14,68 @@ class ValStatus:
     'NOT_RUNNING': 1,
     'DONE_OK': 2,
     'DONE_FAIL': 3,
-    'DISAPPEARED': 4
+    'DISAPPEARED': 4,
+    'STARTING': 5
   })
 
-  def __init__(self, dbpath=None, baseurl=None):
+  def __init__(self, dbpath=None, baseurl=None, busytimeout=30):
     if dbpath is None or baseurl is None:
       raise ValStatusError('dbpath and baseurl are mandatory')
     self._dbpath = dbpath
     self._baseurl = baseurl
+    self._tarball_index = None
     self._log = logging.getLogger('ValStatus')
     self._log.debug('opening SQLite3 database %s' % dbpath)
-    self._db = sqlite3.connect(dbpath)
-    self._db.row_factory = sqlite3_dict_factory
+    import sqlite3
+    # timeout is how long SQLite waits for a lock held by another connection
+    self._db = sqlite3.connect(dbpath, timeout=busytimeout)
+    # rows are accessed by column name without building a dict for each
+    self._db.row_factory = sqlite3.Row
+    cursor = self._db.cursor()
+    # with WAL readers never block the writer and vice versa
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA foreign_keys = ON')
+    self._migrate()
+
+  def close(self):
+    '''Closes the database connection: the object cannot be used afterwards.'''
+    self._log.debug('closing SQLite3 database %s' % self._dbpath)
+    self._db.close()
+    self._tarball_index = None
+
+  def _migrate(self):
+    '''Brings the schema up to date by applying, in order, the migrations
+       newer than the version recorded in the schema_version table. Everything
+       runs in a single immediate transaction, so that concurrent instances
+       never apply the same migration twice.
+    '''
+    self._db.commit()
+    self._db.isolation_level = None  # we handle the transaction ourselves
     cursor = self._db.cursor()
+    try:
+      cursor.execute('BEGIN IMMEDIATE')
+      cursor.execute('CREATE TABLE IF NOT EXISTS schema_version(version INTEGER NOT NULL)')
+      cursor.execute('SELECT MAX(version) AS version FROM schema_version')
+      version = cursor.fetchone()['version'] or 0
+      for v in range(version, len(self.migrations)):
+        self._log.debug('migrating database schema to version %d' % (v+1))
+        self.migrations[v](self, cursor)
+        cursor.execute('INSERT INTO schema_version(version) VALUES(?)', (v+1,))
+      cursor.execute('COMMIT')
+    except:
+      cursor.execute('ROLLBACK')
+      raise
+    finally:
+      self._db.isolation_level = ''
+    self._log.debug('database schema at version %d' % len(self.migrations))
+
+  def _add_column(self, cursor, table, column, coltype):
+    # databases created before versioning might have the column already
+    cursor.execute('PRAGMA table_info(%s)' % table)
+    if column not in [ r['name'] for r in cursor.fetchall() ]:
+      cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, coltype))
+
+  def _migration_create_tables(self, cursor):
     cursor.execute('''
       CREATE TABLE IF NOT EXISTS package(
         package_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,11 +100,117 @@ class ValStatus:
         FOREIGN KEY(package_id) REFERENCES package(package_id)
       )
     ''')
-    cursor.execute('PRAGMA foreign_keys = ON') # not sure
-    self._db.commit()
-    #self._db.close()
+
+  def _migration_package_usage(self, cursor):
+    self._add_column(cursor, 'package', 'last_used', 'INTEGER')
+    self._add_column(cursor, 'package', 'disk_size', 'INTEGER')
+
+  def _migration_indexes(self, cursor):
+    # queue order, listings by status and the dedup in add_validations()
+    cursor.execute('CREATE INDEX IF NOT EXISTS validation_status_inserted ON validation(status, inserted)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS validation_package_status ON validation(package_id, status)')
+    # eviction candidates
+    cursor.execute('CREATE INDEX IF NOT EXISTS package_fetched_last_used ON package(fetched, last_used)')
+
+  def _migration_outbox(self, cursor):
+    cursor.execute('''
+      CREATE TABLE IF NOT EXISTS outbox(
+        mail_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        created      INTEGER NOT NULL,
+        subject      TEXT NOT NULL,
+        body         TEXT NOT NULL,
+        attempts     INTEGER NOT NULL DEFAULT 0,
+        next_attempt INTEGER NOT NULL,
+        last_error   TEXT,
+        sent         INTEGER
+      )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS outbox_sent_next_attempt ON outbox(sent, next_attempt)')
+
+  def _migration_timing(self, cursor):
+    # validation_id is NULL for packages prefetched before their validation
+    cursor.execute('''
+      CREATE TABLE IF NOT EXISTS timing(
+        timing_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+        validation_id INTEGER,
+        package_id    INTEGER NOT NULL,
+        phase         TEXT NOT NULL,
+        started       INTEGER NOT NULL,
+        duration      REAL NOT NULL,
+        FOREIGN KEY(validation_id) REFERENCES validation(validation_id),
+        FOREIGN KEY(package_id) REFERENCES package(package_id)
+      )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS timing_phase_started ON timing(phase, started)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS timing_validation ON timing(validation_id)')
+
+  def _migration_usec(self, cursor):
+    # timestamps were stored as float seconds: convert them to integer
+    # microseconds, as they are declared
+    usec = lambda c: '%s=CAST(ROUND(%s*1000000) AS INTEGER)' % (c, c)
+    for table, columns in [ ('validation', [ 'inserted', 'started', 'ended' ]),
+                            ('package', [ 'last_used' ]),
+                            ('outbox', [ 'created', 'next_attempt', 'sent' ]),
+                            ('timing', [ 'started' ]) ]:
+      cursor.execute('UPDATE %s SET %s' % (table, ','.join([ usec(c) for c in columns ])))
+
+  def _migration_watch(self, cursor):
+    # last seen state of the watched listings: digest of the body and tarballs
+    cursor.execute('''
+      CREATE TABLE IF NOT EXISTS watched_listing(
+        url     TEXT PRIMARY KEY,
+        digest  TEXT NOT NULL,
+        checked INTEGER NOT NULL
+      )
+    ''')
+    cursor.execute('''
+      CREATE TABLE IF NOT EXISTS watched_tarball(
+        url     TEXT NOT NULL,
+        tarball TEXT NOT NULL,
+        PRIMARY KEY(url, tarball)
+      )
+    ''')
+
+  def _migration_deps(self, cursor):
+    # one row per dependency: dep_id is NULL until the package it refers to
+    # is known
+    cursor.execute('''
+      CREATE TABLE IF NOT EXISTS package_dep(
+        package_id INTEGER NOT NULL,
+        org        TEXT NOT NULL,
+        software   TEXT NOT NULL,
+        version    TEXT NOT NULL,
+        dep_id     INTEGER,
+        PRIMARY KEY(package_id, org, software, version),
+        FOREIGN KEY(package_id) REFERENCES package(package_id),
+        FOREIGN KEY(dep_id) REFERENCES package(package_id)
+      )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS package_dep_dep ON package_dep(dep_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS package_name ON package(org, software, version, arch)')
+    cursor.execute('SELECT package_id,deps FROM package WHERE deps IS NOT NULL')
+    self._index_deps(cursor, cursor.fetchall())
+
+  # ordered list of migrations: schema version n is reached by applying the
+  # first n of them. Only ever append to this list
+  migrations = [
+    _migration_create_tables,
+    _migration_package_usage,
+    _migration_indexes,
+    _migration_outbox,
+    _migration_timing,
+    _migration_usec,
+    _migration_watch,
+    _migration_deps
+  ]
+
+  # phases recorded in the timing table, in the order they happen
+  phases = [ 'queue', 'fetch', 'modulefile', 'launch', 'poll', 'poll_failed', 'run' ]
 
   def get_cached_pack_from_tarball(self, tarball, alipacks=None):
+    if self._tarball_index is not None and tarball in self._tarball_index:
+      self._log.debug('package found in tarball index')
+      return self._tarball_index[tarball]
     cursor = self._db.cursor()
     cursor.execute('SELECT * FROM package WHERE tarball=? LIMIT 1', (tarball,))
     result = cursor.fetchone()
@@ -87,26 +237,248 @@ class ValStatus:
       pack = AliPack(dictionary=result, baseurl=self._baseurl)
     return pack
 
-  def get_packages(self):
+  def sync_packages(self, alipacks, dryrun=False):
+    '''Upserts all the given packages into the package table in a single
+       transaction, then builds the in-memory tarball index used by
+       get_cached_pack_from_tarball() until the next sync, which replaces it.
+       The fetched flag of known packages is preserved. Returns the number of new packages.
+    '''
+    rows = []
+    for p in alipacks:
+      rows.append( (p.software, p.version, p.platform, p.arch, p.org, p.get_deps_str(), p.tarball) )
+    self._log.debug('syncing %d package(s) into database' % len(rows))
+    cursor = self._db.cursor()
+    before = self._db.total_changes
+    cursor.executemany('''
+      INSERT OR IGNORE INTO package(software,version,platform,arch,org,deps,tarball)
+      VALUES(?,?,?,?,?,?,?)
+    ''', rows)
+    added = self._db.total_changes - before
+    cursor.executemany('''
+      UPDATE package SET software=?,version=?,platform=?,arch=?,org=?,deps=?
+      WHERE tarball=?
+    ''', rows)
+    deprows = []
+    for p in alipacks:
+      cursor.execute('SELECT package_id,deps FROM package WHERE tarball=?', (p.tarball,))
+      deprows.append( cursor.fetchone() )
+    self._index_deps(cursor, deprows)
+    if dryrun:
+      self._db.rollback()
+      self._log.debug('dry run: sync rolled back')
+    else:
+      self._db.commit()
+      self._log.debug('%d new package(s) synced' % added)
+    self._index_packages(alipacks)
+    return added
+
+  def _index_deps(self, cursor, rows):
+    '''Rebuilds the package_dep rows of the given (package_id, deps string)
+       pairs, then resolves every dependency still unresolved against the
+       known packages of the same arch as the dependent package, or of no
+       arch.
+    '''
+    cursor.executemany('DELETE FROM package_dep WHERE package_id=?', [ (r[0],) for r in rows ])
+    deps = []
+    for package_id, depstr in rows:
+      if not depstr:
+        continue
+      for d in depstr.split(','):
+        name = AliPack.parse_package_name(d.strip())
+        if name is None:
+          self._log.warning('ignoring invalid dependency %s of package %d' % (d, package_id))
+          continue
+        deps.append( (package_id,) + name )
+    cursor.executemany('INSERT OR IGNORE INTO package_dep(package_id,org,software,version) VALUES(?,?,?,?)', deps)
+    cursor.execute('''
+      UPDATE package_dep SET dep_id=(
+        SELECT d.package_id FROM package AS d, package AS p
+        WHERE p.package_id=package_dep.package_id
+        AND d.org=package_dep.org AND d.software=package_dep.software AND d.version=package_dep.version
+        AND (d.arch IS p.arch OR d.arch IS NULL)
+        ORDER BY d.arch IS NULL ASC
+        LIMIT 1
+      ) WHERE dep_id IS NULL
+    ''')
+
+  def get_dependency_graph(self, package_ids):
+    '''Returns the dependencies, direct or not, of the given packages: a
+       dictionary mapping their ids to AliPack objects, a dictionary mapping
+       the ids of the given packages and of their dependencies to the set of
+       ids of their direct dependencies, and the list of (package id,
+       dependency name) of the dependencies which are not known packages.
+    '''
+    package_ids = list(package_ids)
+    cursor = self._db.cursor()
+    roots = ','.join( ['?'] * len(package_ids) )
+    closure = '''
+      WITH RECURSIVE closure(package_id) AS (
+        SELECT package_id FROM package WHERE package_id IN (%s)
+        UNION
+        SELECT dep_id FROM package_dep JOIN closure ON package_dep.package_id=closure.package_id
+        WHERE dep_id IS NOT NULL
+      )
+    '''
+    cursor.execute(closure % roots + '''
+      SELECT package.* FROM package WHERE package_id IN (SELECT package_id FROM closure)
+      AND package_id NOT IN (%s)
+    ''' % roots, package_ids + package_ids)
+    deps = dict( (r['package_id'], AliPack(dictionary=r, baseurl=self._baseurl)) for r in cursor.fetchall() )
+    cursor.execute(closure % roots + '''
+      SELECT package_id,org,software,version,dep_id FROM package_dep WHERE package_id IN (SELECT package_id FROM closure)
+    ''', package_ids)
+    edges = dict( (i, set()) for i in package_ids )
+    edges.update( (i, set()) for i in deps )
+    missing = []
+    for r in cursor.fetchall():
+      if r['dep_id'] is None:
+        missing.append( (r['package_id'], '%s@%s::%s' % (r['org'], r['software'], r['version'])) )
+      else:
+        edges[ r['package_id'] ].add( r['dep_id'] )
+    return deps, edges, missing
+
+  def _index_packages(self, alipacks):
+    # packages of former syncs are dropped: a long-running process would
+    # otherwise keep every package ever listed
+    self._tarball_index = {}
+    cursor = self._db.cursor()
+    for p in alipacks:
+      cursor.execute('SELECT package_id,fetched FROM package WHERE tarball=?', (p.tarball,))
+      r = cursor.fetchone()
+      if r is not None:
+        p.id = r['package_id']
+        p.fetched = (r['fetched'] != 0)
+        self._tarball_index[p.tarball] = p
+    self._log.debug('tarball index has %d package(s)' % len(self._tarball_index))
+
+  def get_packages(self, fetched=None):
+    return list( self.iter_packages(fetched=fetched) )
+
+  def iter_packages(self, fetched=None):
+    cursor = self._db.cursor()
+    if fetched is not None:
+      cursor.execute('SELECT * FROM package WHERE fetched = ?', (1 if fetched else 0,))
+    else:
+      cursor.execute('SELECT * FROM package')
+    for r in cursor:
+      yield AliPack(dictionary=r, baseurl=self._baseurl)
+
+  def get_queued_packages(self, fetched=None, limit=None):
+    '''Returns the packages of queued validations, in queue order. Can filter
+       on the fetched flag.
+    '''
     cursor = self._db.cursor()
-    cursor.execute('SELECT * FROM package')
+    where = ''
+    params = [ self.status.NOT_RUNNING ]
+    if fetched is not None:
+      where = 'AND fetched = ?'
+      params.append( 1 if fetched else 0 )
+    if limit is not None:
+      lim = 'LIMIT ?'
+      params.append(limit)
+    else:
+      lim = ''
+    cursor.execute('''
+      SELECT package.*,MIN(inserted) AS first_inserted FROM validation JOIN package ON package.package_id=validation.package_id
+      WHERE status = ? %s GROUP BY package.package_id ORDER BY first_inserted ASC %s
+    ''' % (where, lim), params)
     packs = []
     for r in cursor:
       packs.append( AliPack(dictionary=r, baseurl=self._baseurl) )
     return packs
 
-  def get_validations(self, status=None):
+  def get_evictable_packages(self):
+    '''Returns the fetched packages that no queued, starting or running
+       validation needs, directly or as a dependency, least recently used
+       first, as (package, validated) tuples: validated tells whether any
+       validation of the package was ever started, i.e. whether its
+       modulefile was written by us and not provided by the site.
+    '''
     cursor = self._db.cursor()
+    cursor.execute('''
+      WITH RECURSIVE needed(package_id) AS (
+        SELECT package_id FROM validation WHERE status IN (?,?,?)
+        UNION
+        SELECT dep_id FROM package_dep JOIN needed ON package_dep.package_id=needed.package_id
+        WHERE dep_id IS NOT NULL
+      )
+      SELECT *,EXISTS (
+        SELECT 1 FROM validation WHERE validation.package_id=package.package_id AND started IS NOT NULL
+      ) AS validated
+      FROM package WHERE fetched = 1 AND package_id NOT IN needed ORDER BY last_used ASC
+    ''', (self.status.NOT_RUNNING, self.status.STARTING, self.status.RUNNING))
+    packs = []
+    for r in cursor:
+      packs.append( (AliPack(dictionary=r, baseurl=self._baseurl), r['validated'] != 0) )
+    return packs
+
+  def get_validations(self, status=None):
     if status is not None:
-      where = 'WHERE status = %d' % status
+      statuses = [ status ]
+    else:
+      statuses = None
+    return list( self.iter_validations(statuses=statuses) )
+
+  def iter_validations(self, statuses=None, since=None, until=None, timefield='inserted', arch=None, platform=None,
+    version_glob=None, after=None, limit=None):
+    '''Generator yielding validations ordered by insertion time, so that the
+       full history never needs to be in memory. All filters are optional:
+         - statuses    : list of allowed status values
+         - since, until: time range (inclusive, UTC timestamps in
+                         microseconds) on timefield, which is either
+                         'inserted' or 'started'
+         - arch, platform: exact match
+         - version_glob: shell-like pattern on the version (SQLite GLOB)
+         - after       : (inserted, validation_id) of the last validation of
+                         the previous page: only subsequent ones are returned
+         - limit       : maximum number of validations
+    '''
+    if timefield not in [ 'inserted', 'started' ]:
+      raise ValStatusError('invalid time field: %s' % timefield)
+    where = []
+    params = []
+    if statuses:
+      where.append( 'status IN (%s)' % ','.join( ['?'] * len(statuses) ) )
+      params.extend(statuses)
+    if since is not None:
+      where.append( '%s >= ?' % timefield )
+      params.append(since)
+    if until is not None:
+      where.append( '%s <= ?' % timefield )
+      params.append(until)
+    if arch is not None:
+      where.append('arch = ?')
+      params.append(arch)
+    if platform is not None:
+      where.append('platform = ?')
+      params.append(platform)
+    if version_glob is not None:
+      where.append('version GLOB ?')
+      params.append(version_glob)
+    if after is not None:
+      where.append('(inserted > ? OR (inserted = ? AND validation_id > ?))')
+      params.extend([ after[0], after[0], after[1] ])
+    if where:
+      where = 'WHERE ' + ' AND '.join(where)
     else:
       where = ''
-    self._log.debug('querying for validations (status=%s)' % status)
-    cursor.execute('SELECT * FROM validation JOIN package ON package.package_id=validation.package_id %s ORDER BY inserted ASC' % where)
-    vals = []
-    for r in cursor:
-      vals.append( Validation(dictionary=r, baseurl=self._baseurl) )
-    return vals
+    if limit is not None:
+      lim = 'LIMIT ?'
+      params.append(limit)
+    else:
+      lim = ''
+    self._log.debug('querying for validations: %s %s' % (where, params))
+    cursor = self._db.cursor()
+    cursor.execute('''
+      SELECT * FROM validation JOIN package ON package.package_id=validation.package_id
+      %s ORDER BY inserted ASC, validation_id ASC %s
+    ''' % (where, lim), params)
+    while True:
+      rows = cursor.fetchmany(500)
+      if not rows:
+        break
+      for r in rows:
+        yield Validation(dictionary=r, baseurl=self._baseurl)
 
   def get_oldest_queued_validation(self):
     cursor = self._db.cursor()
@@ -117,61 +489,393 @@ class ValStatus:
       return None
     return Validation(dictionary=r, baseurl=self._baseurl)
 
+  def claim_queued_validations(self, maxrunning=None, archslots={}, platformslots={}, limit=None, dryrun=False):
+    '''Picks the oldest queued validations fitting in the free slots and marks
+       them as STARTING, so that they count as busy slots for any concurrent
+       instance. Slots are computed from the validation table inside a single
+       immediate transaction: maxrunning is the global number of slots (None
+       means no limit), archslots and platformslots map an arch or a platform
+       to its own number of slots. Returns the list of claimed validations.
+
+       Callers hold the exclusive scheduler lock: any STARTING validation
+       found here was left by a scheduler which died while starting it, and
+       it is put back in the queue first.
+    '''
+    cursor = self._db.cursor()
+    self._db.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+      cursor.execute('UPDATE validation SET status=?,started=NULL WHERE status=?',
+        (self.status.NOT_RUNNING, self.status.STARTING))
+      if cursor.rowcount > 0:
+        self._log.warning('%d validation(s) left starting by a dead scheduler: putting them back in the queue' % \
+          cursor.rowcount)
+      busy = (self.status.RUNNING, self.status.STARTING)
+      total = 0
+      perarch = {}
+      perplatform = {}
+      cursor.execute('''
+        SELECT arch,platform,COUNT(*) AS n FROM validation JOIN package ON package.package_id=validation.package_id
+        WHERE status IN (?,?) GROUP BY arch,platform
+      ''', busy)
+      for r in cursor.fetchall():
+        total += r['n']
+        perarch[r['arch']] = perarch.get(r['arch'], 0) + r['n']
+        perplatform[r['platform']] = perplatform.get(r['platform'], 0) + r['n']
+      self._log.debug('%d busy slot(s), per arch: %s, per platform: %s' % (total, perarch, perplatform))
+
+      claimed = []
+      started = TimeStamp()
+      cursor.execute('SELECT * FROM validation JOIN package ON package.package_id=validation.package_id WHERE status = ? ORDER BY inserted ASC', (self.status.NOT_RUNNING,))
+      for r in cursor.fetchall():
+        if (maxrunning is not None and total >= maxrunning) or (limit is not None and len(claimed) >= limit):
+          break
+        v = Validation(dictionary=r, baseurl=self._baseurl)
+        arch = v.package.arch
+        platform = v.package.platform
+        if arch in archslots and perarch.get(arch, 0) >= archslots[arch]:
+          self._log.debug('no free slots for arch %s: skipping %s' % (arch, v.get_session_tag()))
+          continue
+        if platform in platformslots and perplatform.get(platform, 0) >= platformslots[platform]:
+          self._log.debug('no free slots for platform %s: skipping %s' % (platform, v.get_session_tag()))
+          continue
+        cursor.execute('UPDATE validation SET status=?,started=? WHERE validation_id=? AND status=?',
+          (self.status.STARTING, started.get_timestamp_usec_utc(), v.id, self.status.NOT_RUNNING))
+        v.status = self.status.STARTING
+        v.started = started
+        claimed.append(v)
+        total += 1
+        perarch[arch] = perarch.get(arch, 0) + 1
+        perplatform[platform] = perplatform.get(platform, 0) + 1
+    except:
+      self._db.rollback()
+      raise
+
+    if dryrun:
+      self._db.rollback()
+    else:
+      self._db.commit()
+    self._log.debug('%d validation(s) claimed' % len(claimed))
+    return claimed
+
   def _add_package_cache(self, pack):
     cursor = self._db.cursor()
     cursor.execute('''
       INSERT INTO package(tarball,software,version,platform,arch,org,deps)
       VALUES(?,?,?,?,?,?,?)
     ''',
-    (pack.tarball, pack.software, pack.version, pack.platform, pack.arch, pack.org, ','.join(pack.deps)))
+    (pack.tarball, pack.software, pack.version, pack.platform, pack.arch, pack.org, pack.get_deps_str()))
+    self._index_deps(cursor, [ (cursor.lastrowid, pack.get_deps_str()) ])
     self._db.commit()
     self._log.debug('package %s inserted successfully with id %d' % (pack.get_package_name(), cursor.lastrowid))
+    if self._tarball_index is not None:
+      pack.id = cursor.lastrowid
+      self._tarball_index[pack.tarball] = pack
     return cursor.lastrowid
 
   def add_validation(self, pack):
+    return self.add_validations([ pack ])[0]
+
+  def add_validations(self, packs):
+    '''Queues a validation for each of the given packages in a single
+       transaction. Returns a list of booleans telling, for each package,
+       whether it was queued (False means that it was already queued or in
+       progress).
+    '''
     cursor = self._db.cursor()
     inserted = TimeStamp()
     status = self.status.NOT_RUNNING
-    cursor.execute('SELECT package_id FROM package WHERE tarball=?', (pack.tarball,))
-    package_id = cursor.fetchone()['package_id']  # ValueError
-    self._log.debug('found id %d for %s' % (package_id, pack.tarball))
-    # if a validation for that package which is NOT_RUNNING or RUNNING already exists, don't insert
+    results = []
+    for pack in packs:
+      cursor.execute('SELECT package_id FROM package WHERE tarball=?', (pack.tarball,))
+      package_id = cursor.fetchone()['package_id']  # ValueError
+      self._log.debug('found id %d for %s' % (package_id, pack.tarball))
+      # if a validation for that package which is NOT_RUNNING, STARTING or RUNNING already exists, don't insert
+      cursor.execute('''
+        INSERT INTO validation(inserted,status,package_id)
+        SELECT ?,?,?
+        WHERE NOT EXISTS (
+          SELECT 1 FROM validation WHERE package_id=? AND ( status == ? OR status == ? OR status == ? )
+        )
+      ''', (inserted.get_timestamp_usec_utc(), status, package_id, package_id, self.status.NOT_RUNNING, self.status.RUNNING, self.status.STARTING))
+      if cursor.rowcount == 0:
+        self._log.debug('validation for %s already queued or in progress' % pack.tarball)
+        results.append(False)
+      else:
+        self._log.debug('validation for %s queued with id %d' % (pack.tarball,cursor.lastrowid))
+        results.append(True)
+    self._db.commit()
+    return results
+
+  def update_validation(self, val, mails=[], timings=[]):
+    self.update_validations([ val ], mails=mails, timings=timings)
+
+  def update_validations(self, vals, mails=[], timings=[]):
+    '''Updates all the given validations in a single transaction. Nothing is
+       written if any of them is not in the database. The given mails, a list
+       of (subject, body) tuples, are put in the outbox and the given phase
+       timings (see add_timings()) are recorded in the same transaction.
+    '''
+    cursor = self._db.cursor()
+    self._add_mails(cursor, mails)
+    self._add_timings(cursor, timings)
+    for val in vals:
+      if val.started is None:
+        started = None
+        ended = None
+      elif val.ended is not None:
+        started = val.started.get_timestamp_usec_utc()
+        ended = val.ended.get_timestamp_usec_utc()
+      else:
+        started = val.started.get_timestamp_usec_utc()
+        ended = None
+      self._log.debug('updating validation %s' % val.get_session_tag())
+      cursor.execute('''
+        UPDATE validation SET inserted=?,started=?,ended=?,status=?,package_id=(
+          SELECT package_id FROM package WHERE tarball=? LIMIT 1
+        ) WHERE validation_id=?
+      ''', (val.inserted.get_timestamp_usec_utc(), started, ended, val.status, val.package.tarball, val.id))
+      if cursor.rowcount == 0:
+        self._db.rollback()
+        raise ValStatusError('cannot update: validation not in database')
+    self._db.commit()
+    self._log.debug('%d validation(s) updated' % len(vals))
+
+  def add_mails(self, mails):
+    self._add_mails(self._db.cursor(), mails)
+    self._db.commit()
+
+  def _add_mails(self, cursor, mails):
+    now = TimeStamp().get_timestamp_usec_utc()
+    for subject, body in mails:
+      cursor.execute('INSERT INTO outbox(created,subject,body,next_attempt) VALUES(?,?,?,?)', (now, subject, body, now))
+    if mails:
+      self._log.debug('%d mail(s) added to the outbox' % len(mails))
+
+  def add_timings(self, timings):
+    '''Records phase durations. Each timing is a tuple with the validation
+       (or None), the package, the phase name, its start TimeStamp and its
+       duration in seconds.
+    '''
+    self._add_timings(self._db.cursor(), timings)
+    self._db.commit()
+
+  def _add_timings(self, cursor, timings):
+    rows = []
+    for val, pack, phase, started, duration in timings:
+      if val is not None:
+        valid = val.id
+      else:
+        valid = None
+      rows.append( (valid, pack.id, phase, started.get_timestamp_usec_utc(), duration) )
+    cursor.executemany('INSERT INTO timing(validation_id,package_id,phase,started,duration) VALUES(?,?,?,?,?)', rows)
+
+  def get_phase_stats(self, since=None, until=None, arch=None, platform=None, percentiles=[ 50, 95 ]):
+    '''Returns, for each phase with recorded timings, a dictionary with the
+       phase name, count, mean and max duration and the requested percentiles
+       (nearest rank, keys like p50). Can filter on the time window the phases
+       started in, and on arch and platform. Everything is computed by SQLite.
+    '''
+    where = []
+    params = []
+    if since is not None:
+      where.append('started >= ?')
+      params.append(since)
+    if until is not None:
+      where.append('started <= ?')
+      params.append(until)
+    if arch is not None:
+      where.append('arch = ?')
+      params.append(arch)
+    if platform is not None:
+      where.append('platform = ?')
+      params.append(platform)
+    if where:
+      where = 'AND ' + ' AND '.join(where)
+    else:
+      where = ''
+    cursor = self._db.cursor()
     cursor.execute('''
-      INSERT INTO validation(inserted,status,package_id)
-      SELECT ?,?,?
-      WHERE NOT EXISTS (
-        SELECT 1 FROM validation WHERE package_id=? AND ( status == ? OR status == ? )
-      )
-    ''', (inserted.get_timestamp_usec_utc(), status, package_id, package_id, self.status.NOT_RUNNING, self.status.RUNNING))
+      SELECT phase,COUNT(*) AS count,AVG(duration) AS mean,MAX(duration) AS max
+      FROM timing JOIN package ON package.package_id=timing.package_id
+      WHERE 1 %s GROUP BY phase
+    ''' % where, params)
+    stats = [ dict(zip(r.keys(), r)) for r in cursor.fetchall() ]
+    for st in stats:
+      for p in percentiles:
+        cursor.execute('''
+          SELECT duration FROM timing JOIN package ON package.package_id=timing.package_id
+          WHERE phase = ? %s ORDER BY duration ASC LIMIT 1 OFFSET ?
+        ''' % where, [ st['phase'] ] + params + [ (st['count']*p + 99) // 100 - 1 ])
+        st['p%d' % p] = cursor.fetchone()['duration']
+    def order(st):
+      if st['phase'] in self.phases:
+        return (self.phases.index(st['phase']), st['phase'])
+      return (len(self.phases), st['phase'])
+    stats.sort(key=order)
+    return stats
+
+  def get_watch_digest(self, url):
+    '''Returns the digest of the watched listing at url as last seen, or None
+       if it was never seen.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('SELECT digest FROM watched_listing WHERE url=?', (url,))
+    r = cursor.fetchone()
+    if r is None:
+      return None
+    return r['digest']
+
+  def get_watched_tarballs(self, url):
+    '''Returns the set of tarballs of the watched listing at url as last seen.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('SELECT tarball FROM watched_tarball WHERE url=?', (url,))
+    return set( r['tarball'] for r in cursor.fetchall() )
+
+  def update_watch(self, url, digest, added, removed):
+    '''Records the new state of the watched listing at url, given its digest
+       and the tarballs which appeared and disappeared since last seen, in a
+       single transaction.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('INSERT OR REPLACE INTO watched_listing(url,digest,checked) VALUES(?,?,?)',
+      (url, digest, TimeStamp().get_timestamp_usec_utc()))
+    cursor.executemany('INSERT OR IGNORE INTO watched_tarball(url,tarball) VALUES(?,?)', [ (url, t) for t in added ])
+    cursor.executemany('DELETE FROM watched_tarball WHERE url=? AND tarball=?', [ (url, t) for t in removed ])
     self._db.commit()
-    if cursor.lastrowid == 0:
-      self._log.debug('validation for %s already queued or in progress' % pack.tarball)
-      return False
+
+  def get_status_counts(self):
+    '''Returns a dictionary mapping each validation status to the number of
+       validations in it. Statuses with no validations are missing.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('SELECT status,COUNT(*) AS count FROM validation GROUP BY status')
+    return dict( (r['status'], r['count']) for r in cursor.fetchall() )
+
+  def get_oldest_inserted(self, status):
+    '''Returns the insertion TimeStamp of the oldest validation with the
+       given status, or None if there is none.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('SELECT MIN(inserted) AS inserted FROM validation WHERE status=?', (status,))
+    inserted = cursor.fetchone()['inserted']
+    if inserted is None:
+      return None
+    return TimeStamp(inserted)
+
+  def get_arch_counts(self, status):
+    '''Returns a dictionary mapping each arch to the number of validations with
+       the given status.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('''
+      SELECT arch,COUNT(*) AS count FROM validation JOIN package ON package.package_id=validation.package_id
+      WHERE status=? GROUP BY arch
+    ''', (status,))
+    return dict( (r['arch'], r['count']) for r in cursor.fetchall() )
+
+  def get_duration_histogram(self, buckets, phase=None):
+    '''Returns the cumulative histogram of the durations, in seconds, of the
+       finished validations, or of the given phase if any, as a dictionary
+       with the number of durations less than or equal to each upper bound in
+       buckets, their count and their sum.
+    '''
+    if phase is None:
+      query = 'SELECT (ended-started)/1000000.0 AS d FROM validation WHERE started IS NOT NULL AND ended IS NOT NULL'
+      params = []
     else:
-      self._log.debug('validation for %s queued with id %d' % (pack.tarball,cursor.lastrowid))
-      return True
+      query = 'SELECT duration AS d FROM timing WHERE phase=?'
+      params = [ phase ]
+    cols = ''.join([ ',TOTAL(d <= ?)' for b in buckets ])
+    cursor = self._db.cursor()
+    cursor.execute('SELECT COUNT(*),TOTAL(d)%s FROM (%s)' % (cols, query), list(buckets) + params)
+    r = list( cursor.fetchone() )
+    return {
+      'count': r[0],
+      'sum': r[1],
+      'buckets': [ (b, int(n)) for b, n in zip(buckets, r[2:]) ]
+    }
+
+  def count_timings(self, phase):
+    cursor = self._db.cursor()
+    cursor.execute('SELECT COUNT(*) AS count FROM timing WHERE phase=?', (phase,))
+    return cursor.fetchone()['count']
+
+  def get_outbox_counts(self, maxattempts):
+    '''Returns the number of mails in the outbox never attempted (queued), that
+       failed less than maxattempts times (retrying), that failed maxattempts
+       times and will not be retried (failed) and that were sent.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('''
+      SELECT TOTAL(sent IS NULL AND attempts = 0) AS queued,
+             TOTAL(sent IS NULL AND attempts > 0 AND attempts < ?) AS retrying,
+             TOTAL(sent IS NULL AND attempts >= ?) AS failed,
+             TOTAL(sent IS NOT NULL) AS sent
+      FROM outbox
+    ''', (maxattempts, maxattempts))
+    r = cursor.fetchone()
+    return dict( (k, int(r[k])) for k in r.keys() )
 
-  def update_validation(self, val):
+  def get_pending_mails(self, maxattempts=None):
+    '''Returns the mails of the outbox due for a delivery attempt, oldest
+       first, as dictionaries. Mails which already failed maxattempts times
+       are not returned.
+    '''
     cursor = self._db.cursor()
-    if val.started is None:
-      started = None
-      ended = None
-    elif val.ended is not None:
-      started = val.started.get_timestamp_usec_utc()
-      ended = val.ended.get_timestamp_usec_utc()
+    params = [ TimeStamp().get_timestamp_usec_utc() ]
+    if maxattempts is not None:
+      where = 'AND attempts < ?'
+      params.append(maxattempts)
     else:
-      started = val.started.get_timestamp_usec_utc()
-      ended = None
-    self._log.debug('updating validation %s' % val.get_session_tag())
+      where = ''
     cursor.execute('''
-      UPDATE validation SET inserted=?,started=?,ended=?,status=?,package_id=(
-        SELECT package_id FROM package WHERE tarball=? LIMIT 1
-      ) WHERE validation_id=?
-    ''', (val.inserted.get_timestamp_usec_utc(), started, ended, val.status, val.package.tarball, val.id))
+      SELECT * FROM outbox WHERE sent IS NULL AND next_attempt <= ? %s ORDER BY created ASC, mail_id ASC
+    ''' % where, params)
+    return [ dict(zip(r.keys(), r)) for r in cursor.fetchall() ]
+
+  def mark_mails_sent(self, mail_ids):
+    now = TimeStamp().get_timestamp_usec_utc()
+    self._db.cursor().executemany('UPDATE outbox SET sent=? WHERE mail_id=?', [ (now, i) for i in mail_ids ])
+    self._db.commit()
+
+  def mark_mails_failed(self, mail_ids, error, retrydelay):
+    '''Records a failed delivery attempt of the given mails. The next attempt
+       is scheduled after retrydelay seconds, doubled at each failure.
+    '''
+    now = TimeStamp().get_timestamp_usec_utc()
+    self._db.cursor().executemany('''
+      UPDATE outbox SET attempts=attempts+1,last_error=?,next_attempt=?+(?<<MIN(attempts,6)) WHERE mail_id=?
+    ''', [ (error, now, retrydelay*1000000, i) for i in mail_ids ])
+    self._db.commit()
+
+  def reload_package(self, pack):
+    '''Refreshes the fetched flag, disk size and last use time of the given
+       package from the database, as another process might have changed them.
+    '''
+    cursor = self._db.cursor()
+    cursor.execute('SELECT fetched,disk_size,last_used FROM package WHERE package_id=?', (pack.id,))
+    r = cursor.fetchone()
+    if r is None:
+      raise ValStatusError('cannot reload: package not in database')
+    pack.fetched = (r['fetched'] != 0)
+    pack.disk_size = r['disk_size']
+    if r['last_used'] is not None:
+      pack.last_used = TimeStamp(r['last_used'])
+    else:
+      pack.last_used = None
+
+  def touch_packages(self, package_ids):
+    '''Sets the last use time of the given fetched packages to now, so that
+       packages shared as dependencies are not the first ones evicted.
+    '''
+    if not package_ids:
+      return
+    cursor = self._db.cursor()
+    cursor.execute('UPDATE package SET last_used=? WHERE fetched=1 AND package_id IN (%s)' % \
+      ','.join( ['?'] * len(package_ids) ), [ TimeStamp().get_timestamp_usec_utc() ] + list(package_ids))
     self._db.commit()
-    if cursor.rowcount == 0:
-      raise ValStatusError('cannot update: validation not in database')
-    self._log.debug('validation updated')
 
   def update_package(self, pack):
     cursor = self._db.cursor()
@@ -180,13 +884,17 @@ class ValStatus:
     else:
       fetched = 0
     self._log.debug('updating package cache for %s' % pack.tarball)
+    if pack.last_used is not None:
+      last_used = pack.last_used.get_timestamp_usec_utc()
+    else:
+      last_used = None
     cursor.execute('''
       UPDATE package
-      SET tarball=?,software=?,version=?,platform=?,arch=?,org=?,deps=?,fetched=?
+      SET tarball=?,software=?,version=?,platform=?,arch=?,org=?,deps=?,fetched=?,last_used=?,disk_size=?
       WHERE package_id=?
     ''',
     (pack.tarball, pack.software, pack.version, pack.platform, pack.arch, pack.org,
-      ','.join(pack.deps), fetched, pack.id))
+      pack.get_deps_str(), fetched, last_used, pack.disk_size, pack.id))
     self._db.commit()
     if cursor.rowcount == 0:
       raise ValStatusError('cannot update: package not in database')
@@ -197,7 +905,9 @@ class ValStatusError(Exception):
   pass
 
 
-class Validation:
+class Validation(object):
+
+  __slots__ = ('id', 'inserted', 'started', 'ended', 'status', 'package_id', 'package')
 
   def __init__(self, dictionary=None, baseurl=None):
     if dictionary is None or baseurl is None:
@@ -213,12 +923,11 @@ class Validation:
     elif self.ended is not None:
       started = self.started
       ended = self.ended
-      timetaken = ended-started
+      timetaken = TimeStamp.format_delta(ended-started)
     else:
       started = self.started
       ended = '<not completed>'
-      timetaken = TimeStamp()-started
-      timetaken = str(timetaken) + ' (so far)'
+      timetaken = TimeStamp.format_delta(TimeStamp()-started) + ' (so far)'
     package = str(self.package).replace('\n', '\n   ')
     return \
       'Validation:\n' \